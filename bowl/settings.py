@@ -76,6 +76,18 @@ DATABASES = {
     }
 }
 
+# Cache, used for serialized match state and steps
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+# Use a shared backend such as memcached when running several processes
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        # Room for every step of the matches in play, plus their states
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -95,6 +107,9 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Seconds that spectators are kept behind a live match
+SPECTATOR_DELAY = 0
+
 if heroku:
     import dj_database_url
     DATABASES['default'] =  dj_database_url.config()
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from game.models import Match, Team, Player, PlayerInGame, Challenge, Race
-from game.models import Position, Step
+from game.models import Position, Step, Formation, Snapshot
 
 class PositionInline(admin.TabularInline):
     model = Position
@@ -20,3 +20,5 @@ admin.site.register(Player)
 admin.site.register(PlayerInGame)
 admin.site.register(Challenge)
 admin.site.register(Race, RaceAdmin)
+admin.site.register(Formation)
+admin.site.register(Snapshot)
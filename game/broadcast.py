@@ -0,0 +1,121 @@
+"""Share serialized steps between everyone watching a match.
+
+Each step is turned into JSON once, when it is published, and kept in the
+cache. Spectators' requests are answered by joining those stored payloads,
+so the work done per watcher is a cache read rather than database queries
+and serialization. A step that has dropped out of the cache is read back
+from the database along with the time it was published, so that the
+spectator delay still holds for it.
+"""
+
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from game.models import Match, Step
+
+# Keep step payloads around for long enough to cover a whole match
+STEP_TIMEOUT = 24 * 60 * 60
+# Re-read the match's position from the database at most this often, so
+# that processes that did not publish a step still notice it
+NEXT_POSITION_TIMEOUT = 1
+# How many steps delayed_position() reads from the cache at a time
+DELAY_SEARCH_SIZE = 50
+
+
+def _step_key(match_id, position):
+    return 'broadcast:{}:step:{}'.format(match_id, position)
+
+def _next_key(match_id):
+    return 'broadcast:{}:next'.format(match_id)
+
+def spectator_delay():
+    """Seconds that spectators are kept behind the live match."""
+    return getattr(settings, 'SPECTATOR_DELAY', 0)
+
+def publish(steps):
+    """Serialize newly committed steps and make them visible to watchers."""
+    if not steps:
+        return
+    cache.set_many({_step_key(step.match_id, step.history_position):
+                    _entry(step) for step in steps}, STEP_TIMEOUT)
+    last_step = max(steps, key=lambda step: step.history_position)
+    cache.set(_next_key(last_step.match_id), last_step.history_position + 1,
+              NEXT_POSITION_TIMEOUT)
+
+def next_position(match_id):
+    """Return the history position after the last published step."""
+    position = cache.get(_next_key(match_id))
+    if position is None:
+        position = Match.objects.values_list(
+            'next_position', flat=True).get(id=match_id)
+        cache.set(_next_key(match_id), position, NEXT_POSITION_TIMEOUT)
+    return position
+
+def _entry(step):
+    # Steps from before publish times were kept are long since public
+    return (step.published or 0, json.dumps(step.as_dict()))
+
+def _entries(match_id, positions):
+    """Return the cached (published, payload) for each of the positions,
+    reading any that have dropped out of the cache from the database."""
+    keys = [_step_key(match_id, position) for position in positions]
+    entries = cache.get_many(keys)
+    missing = [position for position, key in zip(positions, keys)
+               if key not in entries]
+    if missing:
+        # A range keeps the query small however many steps are missing
+        filled = {}
+        wanted = set(missing)
+        for step in Step.objects.filter(
+                match_id=match_id, history_position__gte=missing[0],
+                history_position__lt=missing[-1] + 1):
+            if step.history_position in wanted:
+                filled[_step_key(match_id, step.history_position)] = (
+                    _entry(step))
+        cache.set_many(filled, STEP_TIMEOUT)
+        entries.update(filled)
+    return [entries.get(key) for key in keys]
+
+def payloads(match_id, since, delay=0):
+    """Return the JSON for each step from `since` onwards.
+
+    Steps published less than `delay` seconds ago are held back, along
+    with everything after them.
+    """
+    positions = range(since, next_position(match_id))
+    cutoff = time.time() - delay
+    result = []
+    for entry in _entries(match_id, positions):
+        if entry is None or entry[0] > cutoff:
+            break
+        result.append(entry[1])
+    return result
+
+def delayed_position(match_id, delay):
+    """Return the position that watchers `delay` seconds behind reach.
+
+    This is the position of the first step published less than `delay`
+    seconds ago, or the match's next position if there is none.
+    """
+    end = next_position(match_id)
+    if not delay:
+        return end
+    cutoff = time.time() - delay
+    # Steps are published in order, so look back from the latest one
+    for stop in range(end, 0, -DELAY_SEARCH_SIZE):
+        positions = range(max(stop - DELAY_SEARCH_SIZE, 0), stop)
+        entries = _entries(match_id, positions)
+        for position, entry in reversed(list(zip(positions, entries))):
+            # A step that cannot be found is not shown yet
+            if entry is not None and entry[0] <= cutoff:
+                return position + 1
+    return 0
+
+def retract(match_id, position, end):
+    """Forget the steps from `position` up to `end` after a rewind."""
+    cache.delete_many([_step_key(match_id, step_position)
+                       for step_position in range(position, end)])
+    cache.set(_next_key(match_id), position, NEXT_POSITION_TIMEOUT)
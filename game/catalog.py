@@ -0,0 +1,93 @@
+"""An in-memory catalog of the races and the positions they can field.
+
+This reference data comes from define_teams and hardly ever changes, so
+each process loads it once, in two queries, and answers lookups from
+memory after that. Saving or deleting a Race or Position, e.g. in the
+admin, throws the catalog away. A version number in the cache tells other
+processes to do the same.
+
+The objects in the catalog are shared, so treat them as read-only.
+"""
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+from game.models import Position, Race
+
+VERSION_KEY = 'catalog:version'
+
+_catalog = None
+
+
+class Catalog(object):
+    """Every race and position, indexed for lookups."""
+
+    def __init__(self, version):
+        self.version = version
+        self.races = {}
+        self.races_by_id = {}
+        for race in Race.objects.order_by('id'):
+            race.positions = []
+            self.races[race.singular] = race
+            self.races_by_id[race.id] = race
+        self.positions = {}
+        self.positions_by_id = {}
+        for position in Position.objects.order_by('id'):
+            race = self.races_by_id[position.team_race_id]
+            # Share our race rather than fetching it again
+            position.team_race = race
+            race.positions.append(position)
+            self.positions[(race.id, position.title)] = position
+            self.positions_by_id[position.id] = position
+
+    def race_list(self):
+        """Return every race, each with its list of positions."""
+        return list(self.races_by_id.values())
+
+    def race(self, singular):
+        try:
+            return self.races[singular]
+        except KeyError:
+            raise Race.DoesNotExist('Unrecognised race: ' + singular)
+
+    def race_by_id(self, race_id):
+        return self.races_by_id[race_id]
+
+    def position(self, race_id, title):
+        """Return the race's position with the given title."""
+        try:
+            return self.positions[(race_id, title)]
+        except KeyError:
+            raise Position.DoesNotExist('Unrecognised position: ' + title)
+
+    def position_by_id(self, position_id):
+        return self.positions_by_id[position_id]
+
+    def max_quantity(self, race_id, title):
+        """How many players of this position a team may have."""
+        return self.position(race_id, title).max_quantity
+
+
+def get_catalog():
+    """Return the catalog, loading it if it is missing or out of date."""
+    global _catalog
+    version = cache.get(VERSION_KEY, 0)
+    if _catalog is None or _catalog.version != version:
+        _catalog = Catalog(version)
+    return _catalog
+
+def invalidate(**kwargs):
+    """Throw the catalog away in this process and all the others."""
+    global _catalog
+    _catalog = None
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # Nobody has changed the catalog since the cache was last cleared
+        cache.set(VERSION_KEY, 1, None)
+
+for model in (Race, Position):
+    post_save.connect(invalidate, sender=model,
+                      dispatch_uid='catalog-save-' + model.__name__)
+    post_delete.connect(invalidate, sender=model,
+                        dispatch_uid='catalog-delete-' + model.__name__)
@@ -1,4 +1,6 @@
 from game.models import Race, Position
+# Imported so that changes here reach the catalog in every process
+import game.catalog
 
 AMAZON = {
     'singular': 'amazon',
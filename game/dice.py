@@ -0,0 +1,48 @@
+"""Seeded dice, so that every roll in a match can be regenerated.
+
+Each match has a secret seed, and the dice for a step are drawn from a
+stream seeded with the match's seed and the step's history position. The
+same step therefore always gets the same dice, whether it is played live,
+replayed or audited, without the dice themselves being stored.
+"""
+
+import random
+
+# Dice are pre-drawn as 32-bit words, this many at a time
+BLOCK_SIZE = 16
+
+
+def new_seed():
+    """Return a fresh seed for a match."""
+    return random.SystemRandom().getrandbits(63)
+
+def die(word, n_sides):
+    """Turn a random 32-bit word into a roll of an `n_sides`-sided die."""
+    return 1 + ((word * n_sides) >> 32)
+
+
+class DiceStream(object):
+    """The dice for one step of a match."""
+
+    def __init__(self, seed, position):
+        self._random = random.Random('{}:{}'.format(seed, position))
+        self._words = []
+
+    def _draw_block(self):
+        # One call to the generator gives a whole block of words
+        bits = self._random.getrandbits(32 * BLOCK_SIZE)
+        self._words = [(bits >> (32 * i)) & 0xffffffff
+                       for i in range(BLOCK_SIZE - 1, -1, -1)]
+
+    def roll(self, n_sides):
+        """Return a roll of a single die with `n_sides` sides."""
+        if not self._words:
+            self._draw_block()
+        return die(self._words.pop(), n_sides)
+
+
+def dice_stream(seed, position):
+    """Return the dice stream for a step, or None for an unseeded match."""
+    if seed is None:
+        return None
+    return DiceStream(seed, position)
@@ -0,0 +1,154 @@
+"""Run the rules on plain Python objects instead of models.
+
+MatchState and PlayerState hold the same fields as Match and PlayerInGame
+in compact __slots__ objects, and an Engine gives them the interface that
+game.steps.resolve expects of a MatchSession. The rules are the same code
+either way, so anything that plays steps without the database, such as a
+simulation or a test, gets exactly the server's behaviour.
+
+to_engine() and write_back() are the adapter to the models: load a
+session, run steps on an engine made from it, then copy the state back and
+flush the session to save whatever changed.
+"""
+
+from game.dice import dice_stream
+from game.models import Match, PlayerInGame, Step, field_values
+from game.models import formation_placements, formation_positions
+from game.pitch import Pitch
+from game.step_types import parse_step
+from game.steps import recorded_dice, resolve
+
+
+class MatchState(object):
+    __slots__ = (
+        'id', 'home_team_id', 'away_team_id', 'home_score', 'away_score',
+        'turn_number', 'turn_type', 'current_side', 'first_kicking_team',
+        'home_first_direction', 'x_ball', 'y_ball', 'home_rerolls',
+        'away_rerolls', 'home_rerolls_total', 'away_rerolls_total',
+        'home_reroll_used_this_turn', 'away_reroll_used_this_turn',
+        'n_to_place', 'kicking_team', 'active_side', 'active_num',
+        'turn_start_position', 'next_position', 'dice_seed',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    # Use the models' own helpers, so that the rules cannot drift apart
+    end_zone = Match.end_zone
+
+
+class PlayerState(object):
+    __slots__ = (
+        'id', 'player_id', 'match_id', 'side', 'number', 'xpos', 'ypos',
+        'ma', 'st', 'ag', 'av', 'skills', 'skill_bits', 'effect_bits',
+        'action', 'move_left', 'finished_action', 'down', 'stunned',
+        'stunned_this_turn', 'has_ball', 'on_pitch', 'knocked_out',
+        'casualty', 'sent_off', 'tackle_zones',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    has_skill = PlayerInGame.has_skill
+    affected = PlayerInGame.affected
+    add_effect = PlayerInGame.add_effect
+    remove_effect = PlayerInGame.remove_effect
+
+
+def _values(state):
+    return {name: getattr(state, name) for name in state.__slots__}
+
+
+class Engine(object):
+    """A match and its players in memory, ready to have steps resolved."""
+
+    def __init__(self, match, players, formations=None, steps=None):
+        self.match = match
+        self.players = {(player.side, player.number): player
+                        for player in players}
+        # Saved formations, as [number, depth, ypos] keyed by (side, name)
+        self.formations = dict(formations or {})
+        # Each step resolved so far, shaped like Step.as_dict(), by
+        # history position
+        self.steps = dict(steps or {})
+        # Dice to roll instead of the match's seeded stream, if set
+        self.dice = None
+
+    def copy(self):
+        """Return an independent copy of the engine's current state."""
+        return Engine(
+            MatchState(**_values(self.match)),
+            [PlayerState(**_values(player))
+             for player in self.players.values()],
+            self.formations, self.steps)
+
+    def player(self, side, num):
+        return self.players[(side, int(num))]
+
+    def pitch(self):
+        return Pitch(self.players.values())
+
+    def previous_result(self):
+        position = self.match.next_position - 2
+        if position not in self.steps:
+            raise ValueError('No result for history position ' +
+                             str(position))
+        return self.steps[position]['result']
+
+    def previous_step(self, position, ignore=()):
+        for earlier in sorted(self.steps, reverse=True):
+            step = self.steps[earlier]
+            if earlier < position and step['stepType'] not in ignore:
+                return step
+        return None
+
+    def formation_placements(self, side, name):
+        if (side, name) not in self.formations:
+            raise ValueError('No formation called ' + name)
+        return formation_placements(
+            self.match, side, self.formations[(side, name)])
+
+    def save_formation(self, side, name, placements):
+        self.formations[(side, name)] = formation_positions(
+            self.match, side, placements)
+
+    def resolve(self, step_type, data):
+        """Carry out the next step in the match and return its result."""
+        data = parse_step(step_type, data)
+        position = self.match.next_position
+        self.match.next_position = position + 1
+        stream = self.dice
+        if stream is None:
+            stream = dice_stream(self.match.dice_seed, position)
+        with recorded_dice(stream=stream):
+            result = resolve(self, step_type, data)
+        self.steps[position] = dict(data, stepType=step_type, result=result)
+        return result
+
+
+def to_engine(session):
+    """Make an engine from the match and players in a MatchSession."""
+    match = MatchState(id=session.match.pk, **field_values(session.match))
+    players = [PlayerState(id=player.pk, **field_values(player))
+               for player in session.players.values()]
+    # A failed Loner roll repeats the result of the last step, and a
+    # resolveBlock may follow a selectBlockDice step after the block
+    steps = {}
+    for step in Step.objects.filter(
+            match=session.match,
+            history_position__gte=session.match.next_position - 2):
+        steps[step.history_position] = step.as_dict()
+    return Engine(match, players, steps=steps)
+
+def write_back(engine, session):
+    """Copy an engine's state onto the session's models, ready to flush."""
+    for name in MatchState.__slots__:
+        if name != 'id':
+            setattr(session.match, name, getattr(engine.match, name))
+    for key, state in engine.players.items():
+        player = session.players[key]
+        for name in PlayerState.__slots__:
+            if name != 'id':
+                setattr(player, name, getattr(state, name))
@@ -0,0 +1,22 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from game.models import Match, Step
+
+
+class Command(NoArgsCommand):
+    help = ("Set each match's next history position from its steps, for "
+            "matches created before the match kept count itself.")
+
+    def handle_noargs(self, **options):
+        match_table = Match._meta.db_table
+        step_table = Step._meta.db_table
+        with transaction.atomic():
+            # One statement for every match; safe to run more than once
+            cursor = connection.cursor()
+            cursor.execute(
+                'UPDATE {match} SET next_position = COALESCE(('
+                'SELECT MAX(history_position) + 1 FROM {step} '
+                'WHERE {step}.match_id = {match}.id), 0)'.format(
+                    match=match_table, step=step_table))
+            self.stdout.write('Updated {} matches'.format(cursor.rowcount))
@@ -0,0 +1,22 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from game.models import Player, PlayerInGame
+
+
+class Command(NoArgsCommand):
+    help = ("Copy each player's number onto their PlayerInGame rows, for "
+            "matches created before PlayerInGame had its own number.")
+
+    def handle_noargs(self, **options):
+        pig_table = PlayerInGame._meta.db_table
+        player_table = Player._meta.db_table
+        with transaction.atomic():
+            # One statement for every match, rather than a save per player
+            cursor = connection.cursor()
+            cursor.execute(
+                'UPDATE {pig} SET number = (SELECT number FROM {player} '
+                'WHERE {player}.id = {pig}.player_id) '
+                'WHERE number IS NULL'.format(
+                    pig=pig_table, player=player_table))
+            self.stdout.write('Updated {} players'.format(cursor.rowcount))
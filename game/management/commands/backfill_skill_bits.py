@@ -0,0 +1,45 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from game.models import PlayerInGame
+from game.skills import skill_bits
+
+
+class Command(NoArgsCommand):
+    help = ("Fill in the skill and effect bitsets of PlayerInGame rows from "
+            "their skills and effects, for matches created before the "
+            "bitsets existed. Run it before dropping the effects column.")
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            # One statement for each distinct set of skills
+            all_skills = PlayerInGame.objects.values_list(
+                'skills', flat=True).distinct()
+            n_updated = 0
+            for skills in all_skills:
+                n_updated += PlayerInGame.objects.filter(
+                    skills=skills).update(skill_bits=skill_bits(skills))
+            self.stdout.write('Updated {} players'.format(n_updated))
+            self.backfill_effects()
+
+    def backfill_effects(self):
+        # The model no longer has the effects column, so read it directly
+        table = PlayerInGame._meta.db_table
+        cursor = connection.cursor()
+        columns = [column[0] for column in
+                   connection.introspection.get_table_description(
+                       cursor, table)]
+        if 'effects' not in columns:
+            self.stdout.write('No effects column, so effects are left alone')
+            return
+        cursor.execute('SELECT DISTINCT effects FROM {}'.format(table))
+        all_effects = [row[0] for row in cursor.fetchall()]
+        n_updated = 0
+        for effects in all_effects:
+            cursor.execute(
+                'UPDATE {} SET effect_bits = %s WHERE effects = %s'.format(
+                    table),
+                [skill_bits(effects or ''), effects])
+            n_updated += cursor.rowcount
+        self.stdout.write('Updated the effects of {} players'.format(
+            n_updated))
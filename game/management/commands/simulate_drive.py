@@ -0,0 +1,35 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.engine import to_engine
+from game.models import Match
+from game.session import MatchSession
+from game.simulate import simulate
+
+
+class Command(BaseCommand):
+    args = '<match_id>'
+    help = ("Play many rollouts of a drive from a match's current position "
+            "and print the chances of each outcome.")
+    option_list = BaseCommand.option_list + (
+        make_option('--rollouts', type='int', default=10000,
+                    help='How many rollouts to play'),
+        make_option('--turns', type='int', default=1,
+                    help='How many turns each rollout lasts at most'),
+        make_option('--seed', type='int', default=None,
+                    help='Seed the dice, to repeat a run exactly'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the ID of one match')
+        try:
+            session = MatchSession(int(args[0]))
+        except (ValueError, Match.DoesNotExist):
+            raise CommandError('No such match: ' + args[0])
+        summary = simulate(to_engine(session),
+                           n_rollouts=options['rollouts'],
+                           n_turns=options['turns'], seed=options['seed'])
+        self.stdout.write(json.dumps(summary, indent=2, sort_keys=True))
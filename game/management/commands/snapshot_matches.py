@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from game.models import Match, PlayerInGame, save_snapshot
+
+
+class Command(NoArgsCommand):
+    help = ("Take a snapshot of every match that has none, at its current "
+            "position, so that it can be rebuilt from there on. Earlier "
+            "positions of those matches cannot be rebuilt.")
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            matches = Match.objects.filter(snapshot__isnull=True)
+            n_saved = 0
+            for match in matches:
+                save_snapshot(
+                    match, PlayerInGame.objects.filter(match=match))
+                n_saved += 1
+            self.stdout.write('Saved {} snapshots'.format(n_saved))
@@ -1,11 +1,13 @@
 import json
-import re
 from collections import defaultdict
 
 from django.db import models
 from django.contrib.auth.models import User
 from django.template.defaultfilters import slugify
 
+from game.dice import new_seed
+from game.skills import all_recognised, skill_bits, skill_names
+
 
 class Race(models.Model):
     singular = models.CharField(max_length=50)
@@ -34,18 +36,26 @@ class Team(models.Model):
 
     def update_value(self):
         """Recalculate the value of the team."""
-        value = 0
-        for player in self.player_set.all():
-            value += player.value
-        value += self.rerolls * self.race.reroll_cost
+        from game.catalog import get_catalog
+        value = self.player_set.aggregate(total=models.Sum('value'))['total']
+        value = value or 0
+        race = get_catalog().race_by_id(self.race_id)
+        value += self.rerolls * race.reroll_cost
         value += self.cash
         self.value = value
         self.save()
         return
 
-    def valid_starting_team(self):
-        """Return True if this is a valid starting team."""
-        if self.player_set.count() < 11:
+    def valid_starting_team(self, players=None):
+        """Return True if this is a valid starting team.
+
+        Pass the players to check a team before it has been saved.
+        """
+        from game.catalog import get_catalog
+        catalog = get_catalog()
+        if players is None:
+            players = list(self.player_set.all())
+        if len(players) < 11:
             return False
         if self.cash < 0:
             return False
@@ -57,38 +67,33 @@ class Team(models.Model):
             return False
         if self.name == '':
             return False
-        name_list = []
+        names = set()
         position_tally = defaultdict(int)
-        for player in self.player_set.all():
+        for player in players:
             if player.name == '':
                 return False
-            if player.name in name_list:
+            if player.name in names:
+                return False
+            names.add(player.name)
+            if not all_recognised(player.skills):
                 return False
-            name_list.append(player.name)
-            position_tally[player.position.title] += 1
-            if (position_tally[player.position.title] > 
-                    player.position.max_quantity):
+            position = catalog.position_by_id(player.position_id)
+            position_tally[position.title] += 1
+            if position_tally[position.title] > position.max_quantity:
                 return False
 
         return True
 
 def create_team(name, race, coach, **kwargs):
     team = Team(name=name, race=race, coach=coach, **kwargs)
+    # Fetch every slug that could clash, then pick the first one left
     slug = slugify(name)
-    try:
-        Team.objects.get(slug=slug)
-    except Team.DoesNotExist:
-        pass
-    else:
-        i = 1
-        while True:
-            try:
-                slug = slugify(name) + '-' + str(i)
-                Team.objects.get(slug=slug)
-            except Team.DoesNotExist:
-                break
-            else:
-                i += 1
+    taken = set(Team.objects.filter(
+        slug__startswith=slug).values_list('slug', flat=True))
+    i = 1
+    while slug in taken:
+        slug = slugify(name) + '-' + str(i)
+        i += 1
     team.slug = slug
     return team
 
@@ -148,8 +153,8 @@ class Player(models.Model):
         return self.name
 
 def create_player(team, position_title, name, number):
-    position = Position.objects.get(
-        title=position_title, team_race=team.race)
+    from game.catalog import get_catalog
+    position = get_catalog().position(team.race_id, position_title)
     player = Player(
         name=name,
         race=position.race,
@@ -188,6 +193,12 @@ class Match(models.Model):
     away_reroll_used_this_turn = models.BooleanField(default=False)
     n_to_place = models.IntegerField(default=0)
     kicking_team = models.CharField(max_length=4)
+    active_side = models.CharField(max_length=4, blank=True, default='')
+    active_num = models.IntegerField(null=True, default=None)
+    turn_start_position = models.IntegerField(default=0)
+    next_position = models.IntegerField(default=0)
+    # Seeds the dice for every step; never shown to the coaches
+    dice_seed = models.BigIntegerField(null=True)
 
     def __str__(self):
         return self.home_team.slug + ' vs ' + self.away_team.slug
@@ -216,6 +227,9 @@ class Match(models.Model):
             'awayRerollUsedThisTurn': self.away_reroll_used_this_turn,
             'nToPlace': self.n_to_place,
             'kickingTeam': self.kicking_team,
+            'activeSide': self.active_side,
+            'activeNum': self.active_num,
+            'turnStartPosition': self.turn_start_position,
         }
         return result_dict
 
@@ -227,6 +241,22 @@ class Match(models.Model):
         else:
             raise ValueError('Unrecognised side: ' + side)
 
+    def end_zone(self, side):
+        """Return the x position of the end zone that a side defends."""
+        if ((self.home_first_direction == 'right' and
+             self.turn_number <= 8) or
+            (self.home_first_direction == 'left' and
+             self.turn_number >= 9)):
+            home_end_zone = 0
+        else:
+            home_end_zone = 25
+        if side == 'home':
+            return home_end_zone
+        elif side == 'away':
+            return 25 - home_end_zone
+        else:
+            raise ValueError('Unrecognised side: ' + side)
+
 def start_match(home_team, away_team, first_kicking_team=None,
                 home_first_direction=None):
     """Create a match between the two sides."""
@@ -246,32 +276,37 @@ def start_match(home_team, away_team, first_kicking_team=None,
         away_rerolls=away_team.rerolls,
         home_rerolls_total=home_team.rerolls,
         away_rerolls_total=away_team.rerolls,
+        dice_seed=new_seed(),
         )
     match.save()
+    players = []
     for home_player in home_team.player_set.all():
-        create_pig(home_player, match=match, xpos=0, ypos=0,
-                   on_pitch=True, side='home').save()
+        players.append(create_pig(home_player, match=match, xpos=0, ypos=0,
+                                  on_pitch=True, side='home'))
     for away_player in away_team.player_set.all():
-        create_pig(away_player, match=match, xpos=0, ypos=0,
-                   on_pitch=True, side='away').save()
-    set_kickoff(match, first_kicking_team)
+        players.append(create_pig(away_player, match=match, xpos=0, ypos=0,
+                                  on_pitch=True, side='away'))
+    set_kickoff(match, first_kicking_team, players)
+    PlayerInGame.objects.bulk_create(players)
+    match.save()
+    # bulk_create does not give us the new primary keys, so fetch them back
+    save_snapshot(match, match.playeringame_set.all())
     return match
 
-def set_kickoff(match, kicking_team):
-    """Set a kickoff for this match."""
+def set_kickoff(match, kicking_team, players):
+    """Set a kickoff for this match.
+
+    The match and players are updated in place; saving them is left to the
+    caller.
+    """
     # Work out which side of the pitch each team is on
-    if ((match.home_first_direction == 'right' and match.turn_number <= 8) or
-        (match.home_first_direction == 'left' and match.turn_number >= 9)):
-        xpos_home = 0
-        xpos_away = 25
-    else:
-        xpos_home = 25
-        xpos_away = 0
+    xpos_home = match.end_zone('home')
+    xpos_away = match.end_zone('away')
     # Start placing players at the top of the pitch
     ypos_home = 0
     ypos_away = 0
-    for pig in match.playeringame_set.all():
-        if pig.player.team == match.home_team:
+    for pig in players:
+        if pig.side == 'home':
             pig.xpos = xpos_home
             pig.ypos = ypos_home
             if ypos_home == 14:
@@ -303,20 +338,67 @@ def set_kickoff(match, kicking_team):
         pig.move_left = pig.ma
         pig.action = ''
         pig.finished_action = False
-        pig.save()
     match.n_to_place = 2
     match.kicking_team = kicking_team
     match.current_side = kicking_team
     match.x_ball = None
     match.y_ball = None
     match.turn_type = 'placePlayers'
-    match.save()
+    match.active_side = ''
+    match.active_num = None
+
+
+class Formation(models.Model):
+    """A saved kickoff setup that a team can reuse.
+
+    Positions are stored as a JSON list of [number, depth, ypos], where
+    depth counts squares out from the team's own end zone so that the same
+    formation works whichever way the team is playing.
+    """
+    team = models.ForeignKey(Team)
+    name = models.CharField(max_length=50)
+    positions = models.TextField()
+
+    class Meta:
+        unique_together = ('team', 'name')
+
+    def __str__(self):
+        return self.team.slug + ' ' + self.name
+
+    def placements(self, match, side):
+        """Return the formation as [number, xpos, ypos] for this match."""
+        return formation_placements(match, side, json.loads(self.positions))
+
+def formation_placements(match, side, positions):
+    """Turn [number, depth, ypos] positions into [number, xpos, ypos]."""
+    end_zone = match.end_zone(side)
+    return [[num, abs(end_zone - depth), ypos]
+            for num, depth, ypos in positions]
+
+def formation_positions(match, side, placements):
+    """Turn [number, xpos, ypos] placements into [number, depth, ypos]."""
+    end_zone = match.end_zone(side)
+    return [[num, abs(xpos - end_zone), ypos]
+            for num, xpos, ypos in placements]
+
+def save_formation(team, name, positions):
+    """Save [number, depth, ypos] positions as one of a team's formations."""
+    formation, created = Formation.objects.get_or_create(
+        team=team, name=name,
+        defaults={'positions': json.dumps(positions)})
+    if not created:
+        formation.positions = json.dumps(positions)
+        formation.save()
+    return formation
 
 
 class PlayerInGame(models.Model):
     player = models.ForeignKey(Player)
     match = models.ForeignKey(Match)
     side = models.CharField(max_length=4)
+    # Copied from the player, so that a player can be found by side and
+    # number without joining through Player
+    number = models.IntegerField(null=True)
     xpos = models.IntegerField()
     ypos = models.IntegerField()
     ma = models.IntegerField()
@@ -324,7 +406,10 @@ class PlayerInGame(models.Model):
     ag = models.IntegerField()
     av = models.IntegerField()
     skills = models.TextField()
-    effects = models.TextField()
+    # Bitsets of the skills above and of the effects on the player, using
+    # the bits from game.skills
+    skill_bits = models.IntegerField(default=0)
+    effect_bits = models.IntegerField(default=0)
     action = models.CharField(max_length=8)
     move_left = models.IntegerField()
     finished_action = models.BooleanField(default=False)
@@ -338,6 +423,10 @@ class PlayerInGame(models.Model):
     sent_off = models.BooleanField(default=False)
     tackle_zones = models.BooleanField(default=True)
 
+    class Meta:
+        unique_together = ('match', 'side', 'number')
+        index_together = [('match', 'on_pitch', 'xpos', 'ypos')]
+
     def __str__(self):
         return self.player.name
 
@@ -345,7 +434,7 @@ class PlayerInGame(models.Model):
         result_dict = {
             'side': self.side,
             'name': self.player.name,
-            'num': self.player.number,
+            'num': self.number,
             'position': self.player.position.title,
             'race': self.player.race,
             'xpos': self.xpos,
@@ -355,7 +444,7 @@ class PlayerInGame(models.Model):
             'ag': self.ag,
             'av': self.av,
             'skills': self.skills.split(','),
-            'effects': self.effects.split(','),
+            'effects': skill_names(self.effect_bits),
             'action': self.action,
             'moveLeft': self.move_left,
             'finishedAction': self.finished_action,
@@ -372,58 +461,60 @@ class PlayerInGame(models.Model):
         return result_dict
 
     def has_skill(self, skill):
-        return skill in self.skills.split(',')
-        
+        """Check for a skill, given its bit from game.skills."""
+        return bool(self.skill_bits & skill)
+
     def affected(self, effect):
-        return effect in self.effects.split(',')
-        
+        return bool(self.effect_bits & effect)
+
     def add_effect(self, effect):
-        if not self.affected(effect):
-            if len(self.effects) != 0:
-                self.effects = self.effects + ','
-            self.effects = self.effects + effect
-            self.save()
-            
+        self.effect_bits |= effect
+
     def remove_effect(self, effect):
-        mat = re.match('^(.+,)?(?P<effect>'+effect+')(,.+)?$', self.effects)
-        if not mat:
-            return
-        start = mat.start('effect')
-        finish = mat.end('effect')
-        if start > 0:
-            # Also remove a preceding comma
-            start -= 1
-        else:
-            if finish < len(self.effects):
-                # Instead, remove a following comma
-                finish += 1
-            else:
-                # There are no commas!
-                pass
-        self.effects = self.effects[:start] + self.effects[finish:]
-        self.save()
+        self.effect_bits &= ~effect
 
 def create_pig(parent, **kwargs):
     pig = PlayerInGame()
     pig.player = parent
+    pig.number = parent.number
     pig.ma = parent.ma
     pig.st = parent.st
     pig.ag = parent.ag
     pig.av = parent.av
     pig.skills = parent.skills
+    pig.skill_bits = skill_bits(parent.skills)
     pig.move_left = parent.ma
     for key, value in kwargs.items():
         setattr(pig, key, value)
     return pig
 
 
+def compact_json(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
 class Step(models.Model):
     step_type = models.CharField(max_length=20)
     action = models.CharField(max_length=20)
     match = models.ForeignKey(Match)
     history_position = models.IntegerField()
+    # The fields that most steps have get their own columns, and
+    # everything else goes in properties
+    side = models.CharField(max_length=4, blank=True)
+    num = models.IntegerField(null=True)
+    x0 = models.IntegerField(null=True)
+    y0 = models.IntegerField(null=True)
+    x1 = models.IntegerField(null=True)
+    y1 = models.IntegerField(null=True)
     properties = models.TextField()
     result = models.TextField()
+    # Every dice roll made by the step, in order, for replaying it
+    rolls = models.TextField(blank=True)
+    # The fields of the match and players that the step changed
+    diff = models.TextField(blank=True)
+    # When the step was committed, as a Unix time, for holding it back from
+    # spectators; null for steps from before this was recorded
+    published = models.FloatField(null=True)
 
     class Meta:
         unique_together = ('match', 'history_position')
@@ -431,20 +522,71 @@ class Step(models.Model):
     def __str__(self):
         return 'Match {} step {}'.format(self.match.id, self.history_position)
 
-    def as_dict(self):
+    COLUMNS = ('side', 'num', 'action', 'x0', 'y0', 'x1', 'y1')
+
+    def set_data(self, data):
+        """Store a step's parsed data, putting common fields in columns."""
+        properties = dict(data)
+        for name in self.COLUMNS:
+            setattr(self, name, properties.pop(name, None))
+        self.side = self.side or ''
+        self.action = self.action or ''
+        self.properties = compact_json(properties)
+
+    def data(self):
+        """Return the step's data as it was passed to set_data()."""
         if self.properties:
-            step_dict = json.loads(self.properties)
+            data = json.loads(self.properties)
         else:
-            step_dict = {}
+            data = {}
+        for name in self.COLUMNS:
+            value = getattr(self, name)
+            if value is not None and value != '':
+                data[name] = value
+        return data
+
+    def as_dict(self):
+        step_dict = self.data()
         if self.result:
             result_dict = json.loads(self.result)
         else:
             result_dict = {}
         step_dict['result'] = result_dict
+        if self.diff:
+            step_dict['diff'] = json.loads(self.diff)
         step_dict['stepType'] = self.step_type
-        step_dict['matchId'] = self.match.id
+        step_dict['matchId'] = self.match_id
         step_dict['historyPosition'] = self.history_position
         return step_dict
 
 
+class Snapshot(models.Model):
+    """The state of a match and its players before a given step."""
+    match = models.ForeignKey(Match)
+    history_position = models.IntegerField()
+    state = models.TextField()
+
+    class Meta:
+        unique_together = ('match', 'history_position')
 
+    def __str__(self):
+        return 'Match {} snapshot {}'.format(
+            self.match_id, self.history_position)
+
+def field_values(obj):
+    """Return the value of every field apart from the primary key."""
+    return {field.attname: getattr(obj, field.attname)
+            for field in obj._meta.concrete_fields
+            if not field.primary_key}
+
+def save_snapshot(match, players):
+    """Record the current state of the match at its next position."""
+    state = {
+        'match': field_values(match),
+        'players': {player.pk: field_values(player) for player in players},
+    }
+    Snapshot.objects.filter(
+        match=match, history_position=match.next_position).delete()
+    return Snapshot.objects.create(
+        match=match, history_position=match.next_position,
+        state=json.dumps(state))
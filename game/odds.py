@@ -0,0 +1,225 @@
+"""Exact odds for the dice that the rules roll.
+
+Each probability follows the same rules as game.steps and is worked out
+exactly as a Fraction. Single rolls are memoized by the player's stats
+and modifiers. A chain of rolls, such as dodge, go for it, pick up, is
+solved by a memoized search over the rerolls still available. Asking the
+same question again, e.g. while a coach hovers over squares, is then a
+cache lookup.
+
+Rerolls are counted the way resolve() handles them. A failed roll may be
+rerolled once, with a skill if the player has the right one or with the
+team reroll. A Loner player must roll 4+ before any reroll counts.
+"""
+
+from fractions import Fraction
+from functools import lru_cache
+
+from game import skills
+from game.models import Step
+from game.steps import BLOCK_DICE, block_strength, n_block_dice, on_pitch
+
+D6 = range(1, 7)
+
+# Chains differ by path, so keep only the most recently asked
+CHAIN_CACHE_SIZE = 4096
+
+# The chance of each total on two dice
+TWO_D6 = {total: Fraction(6 - abs(total - 7), 36) for total in range(2, 13)}
+
+GO_FOR_IT = Fraction(5, 6)
+LONER = Fraction(1, 2)
+
+# The skill that lets a player reroll each kind of agility roll
+REROLL_SKILLS = {
+    'dodge': skills.DODGE,
+    'pickUp': skills.SURE_HANDS,
+    'catch': skills.CATCH,
+    'pass': skills.PASS,
+}
+
+
+@lru_cache(maxsize=None)
+def agility(ag, modifier=0):
+    """Chance of passing an agility roll, as in roll_agility_dice()."""
+    required_result = 7 - min(ag, 6)
+    passes = [roll for roll in D6 if roll == 6 or
+              (roll != 1 and roll + modifier >= required_result)]
+    return Fraction(len(passes), 6)
+
+@lru_cache(maxsize=None)
+def armour(av, modifier=0):
+    """Chance of breaking armour, as in roll_armour_dice()."""
+    return sum((chance for total, chance in TWO_D6.items()
+                if total + modifier > av), Fraction(0))
+
+@lru_cache(maxsize=None)
+def _injury(modifier, thick_skull, regeneration):
+    results = dict.fromkeys(
+        ('stunned', 'knockedOut', 'casualty', 'regenerated'), Fraction(0))
+    for total, chance in TWO_D6.items():
+        total += modifier
+        if total <= 7 or (total == 8 and thick_skull):
+            results['stunned'] += chance
+        elif total <= 9:
+            results['knockedOut'] += chance
+        elif regeneration:
+            results['casualty'] += chance / 2
+            results['regenerated'] += chance / 2
+        else:
+            results['casualty'] += chance
+    return results
+
+def injury(modifier=0, thick_skull=False, regeneration=False):
+    """Return the chance of each result of roll_injury_dice()."""
+    return dict(_injury(modifier, thick_skull, regeneration))
+
+@lru_cache(maxsize=None)
+def _knock_down(av, mighty_blow, thick_skull, regeneration):
+    results = dict.fromkeys(
+        ('prone', 'stunned', 'knockedOut', 'casualty', 'regenerated'),
+        Fraction(0))
+    for total, chance in TWO_D6.items():
+        injury_modifier = 0
+        if mighty_blow == 'armour':
+            total += 1
+        elif mighty_blow == 'injury':
+            injury_modifier = 1
+        elif mighty_blow is True:
+            # Used on whichever roll it makes a difference to
+            if total > av:
+                injury_modifier = 1
+            else:
+                total += 1
+        if total > av:
+            for result, odds in _injury(
+                    injury_modifier, thick_skull, regeneration).items():
+                results[result] += chance * odds
+        else:
+            results['prone'] += chance
+    return results
+
+def knock_down(av, mighty_blow=False, thick_skull=False,
+               regeneration=False):
+    """Return the chance of each outcome of knock_down().
+
+    'prone' means the armour held.
+    """
+    return dict(_knock_down(av, mighty_blow, thick_skull, regeneration))
+
+def good_block_faces(attacker_skills=0, defender_skills=0):
+    """Count the faces of a block die that knock the defender over and
+    leave the attacker standing."""
+    good = 0
+    for face in BLOCK_DICE.values():
+        if (face == 'defenderDown' or
+                (face == 'defenderStumbles' and
+                 not defender_skills & skills.DODGE) or
+                (face == 'bothDown' and attacker_skills & skills.BLOCK and
+                 not defender_skills & skills.BLOCK)):
+            good += 1
+    return good
+
+@lru_cache(maxsize=None)
+def block(n_dice, attacker_chooses, attacker_skills=0, defender_skills=0):
+    """Chance that a roll of the block dice knocks the defender over
+    without the attacker falling."""
+    face = Fraction(good_block_faces(attacker_skills, defender_skills), 6)
+    if attacker_chooses:
+        return 1 - (1 - face) ** n_dice
+    return face ** n_dice
+
+@lru_cache(maxsize=CHAIN_CACHE_SIZE)
+def chain(rolls, team_reroll=False, player_skills=0, dodge_used=False):
+    """Return the chance of passing every roll in `rolls` in turn.
+
+    Each roll is a (chance, skill) pair, where skill is the bit of the
+    skill that can reroll it, or 0. After a failure the reroll that gives
+    the best chance for the rest of the chain is used. Dodge can only be
+    used once a turn and the team reroll only once.
+    """
+    if not rolls:
+        return Fraction(1)
+    (chance, skill), rest = rolls[0], rolls[1:]
+    odds = chance * chain(rest, team_reroll, player_skills, dodge_used)
+    reroll = chance
+    if player_skills & skills.LONER:
+        reroll *= LONER
+    options = []
+    if (player_skills & skill and
+            not (skill == skills.DODGE and dodge_used)):
+        options.append(reroll * chain(
+            rest, team_reroll, player_skills,
+            dodge_used or skill == skills.DODGE))
+    if team_reroll:
+        options.append(reroll * chain(
+            rest, False, player_skills, dodge_used))
+    if options:
+        odds += (1 - chance) * max(options)
+    return odds
+
+def team_reroll_available(match, side):
+    return (getattr(match, side + '_rerolls') > 0 and
+            not getattr(match, side + '_reroll_used_this_turn'))
+
+def dodge_used(match, player):
+    """Whether the player has already used Dodge this turn."""
+    steps = Step.objects.filter(
+        match_id=match.id, step_type='reroll', side=player.side,
+        num=player.number, history_position__gte=match.turn_start_position)
+    return any(step.data().get('rerollSkill') == 'Dodge' for step in steps)
+
+def path_rolls(session, player, path):
+    """Return the rolls a player would make moving along `path`, as
+    move_square() would make them.
+
+    Raises ValueError for a square that move_square() would not allow.
+    """
+    pitch = session.pitch()
+    match = session.match
+    xpos, ypos = player.xpos, player.ypos
+    move_left = player.move_left
+    rolls = []
+    for x1, y1 in path:
+        # The player's own starting square is left empty once they move
+        if (not on_pitch(x1, y1) or
+                (pitch.is_occupied(x1, y1) and
+                 (x1, y1) != (player.xpos, player.ypos)) or
+                max(abs(x1 - xpos), abs(y1 - ypos)) != 1 or
+                move_left <= -2):
+            raise ValueError('Cannot move to square: ' + str((x1, y1)))
+        if move_left <= 0:
+            rolls.append((GO_FOR_IT, 0))
+        if pitch.tackle_zones_at(player.side, xpos, ypos) > 0:
+            modifier = 1 - pitch.tackle_zones_at(player.side, x1, y1)
+            rolls.append((agility(player.ag, modifier),
+                          REROLL_SKILLS['dodge']))
+        xpos, ypos = x1, y1
+        move_left -= 1
+        if (not player.has_ball and match.x_ball is not None and
+                (int(match.x_ball), int(match.y_ball)) == (x1, y1)):
+            modifier = 1 - pitch.tackle_zones_at(player.side, x1, y1)
+            rolls.append((agility(player.ag, modifier),
+                          REROLL_SKILLS['pickUp']))
+    return tuple(rolls)
+
+def path_odds(session, player, path):
+    """Chance of moving along `path` without falling over or dropping
+    the ball."""
+    match = session.match
+    return chain(path_rolls(session, player, path),
+                 team_reroll_available(match, player.side),
+                 player.skill_bits, dodge_used(match, player))
+
+def block_odds(session, attacker, defender):
+    """Chance that a block knocks the defender over, using the team
+    reroll if it is available."""
+    pitch = session.pitch()
+    attack_st = block_strength(pitch, attacker, defender)
+    defence_st = block_strength(pitch, defender, attacker)
+    chance = block(n_block_dice(attack_st, defence_st),
+                   attack_st >= defence_st,
+                   attacker.skill_bits, defender.skill_bits)
+    return chain(((chance, 0),),
+                 team_reroll_available(session.match, attacker.side),
+                 attacker.skill_bits)
@@ -0,0 +1,131 @@
+"""An in-memory picture of the pitch for a single match.
+
+Each side's players are held as bitboards: one bit per square of the 26x15
+pitch, numbered row by row from the top-left corner. Tackle zones, assists
+and helpers are then counted by masking a side's bitboard with the 3x3
+neighbourhood of a square, so no further database work is needed once the
+pitch has been built.
+"""
+
+WIDTH = 26
+HEIGHT = 15
+
+
+def square(xpos, ypos):
+    """Return the bit index of the square at (xpos, ypos)."""
+    return ypos * WIDTH + xpos
+
+def _neighbourhood(xpos, ypos):
+    mask = 0
+    for x in range(xpos-1, xpos+2):
+        for y in range(ypos-1, ypos+2):
+            if 0 <= x < WIDTH and 0 <= y < HEIGHT:
+                mask |= 1 << square(x, y)
+    return mask
+
+# The square itself and everything adjacent to it, indexed by square()
+NEIGHBOURHOOD = [_neighbourhood(x, y)
+                 for y in range(HEIGHT) for x in range(WIDTH)]
+
+def count_bits(bits):
+    return bin(bits).count('1')
+
+
+class Pitch(object):
+    """Occupancy and tackle-zone bitboards for the players in a match."""
+
+    def __init__(self, players):
+        self.players = {}
+        self.squares = {}
+        self.occupied = {'home': 0, 'away': 0}
+        self.standing = {'home': 0, 'away': 0}
+        self.tackle_zones = {'home': 0, 'away': 0}
+        for player in players:
+            self.add(player)
+
+    @classmethod
+    def from_match(cls, match):
+        """Build the pitch from the match's players in a single query."""
+        from game.models import PlayerInGame
+        return cls(PlayerInGame.objects.filter(match=match, on_pitch=True))
+
+    def add(self, player):
+        """Put a player on the pitch, using their current state."""
+        if not player.on_pitch:
+            return
+        bit = 1 << square(player.xpos, player.ypos)
+        key = (player.side, player.number)
+        self.players[key] = player
+        self.squares[key] = bit
+        self.occupied[player.side] |= bit
+        if not player.down:
+            self.standing[player.side] |= bit
+        if player.tackle_zones:
+            self.tackle_zones[player.side] |= bit
+
+    def remove(self, player):
+        """Take a player off the pitch."""
+        key = (player.side, player.number)
+        bit = self.squares.pop(key, 0)
+        self.players.pop(key, None)
+        self.occupied[player.side] &= ~bit
+        self.standing[player.side] &= ~bit
+        self.tackle_zones[player.side] &= ~bit
+
+    def update(self, player):
+        """Refresh the pitch after a player has moved or changed state."""
+        self.remove(player)
+        self.add(player)
+
+    def player(self, side, num):
+        return self.players[(side, int(num))]
+
+    def player_at(self, xpos, ypos):
+        """Return the player standing or lying on a square, if any."""
+        bit = 1 << square(xpos, ypos)
+        for key, player_bit in self.squares.items():
+            if player_bit == bit:
+                return self.players[key]
+        return None
+
+    def is_occupied(self, xpos, ypos):
+        bit = 1 << square(xpos, ypos)
+        return any(bits & bit for bits in self.occupied.values())
+
+    def neighbourhood(self, player):
+        return NEIGHBOURHOOD[square(player.xpos, player.ypos)]
+
+    def n_tackle_zones(self, player):
+        """Count the opposing tackle zones that the player is standing in."""
+        return self.tackle_zones_at(player.side, player.xpos, player.ypos)
+
+    def tackle_zones_at(self, side, xpos, ypos):
+        """Count the tackle zones against `side` on a square."""
+        mask = NEIGHBOURHOOD[square(xpos, ypos)]
+        return sum(count_bits(bits & mask)
+                   for other, bits in self.tackle_zones.items()
+                   if other != side)
+
+    def n_assists(self, assisted, target, allowed_zones):
+        """Count the players who can assist `assisted` against `target`.
+
+        An assisting player is on the same side as `assisted`, standing next
+        to `target` with tackle zones of their own, and in no more than
+        `allowed_zones` opposing tackle zones.
+        """
+        mask = (self.neighbourhood(target) &
+                self.standing[assisted.side] &
+                self.tackle_zones[assisted.side])
+        mask &= ~self.squares.get(
+            (assisted.side, assisted.number), 0)
+        n_assists = 0
+        for key, bit in self.squares.items():
+            if (key[0] == assisted.side and bit & mask and
+                    self.n_tackle_zones(self.players[key]) == allowed_zones):
+                n_assists += 1
+        return n_assists
+
+    def n_helpers(self, player):
+        """Count the standing team-mates next to the player."""
+        return count_bits(
+            self.neighbourhood(player) & self.standing[player.side]) - 1
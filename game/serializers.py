@@ -0,0 +1,88 @@
+"""Turn a match into the JSON-ready data used by the game page.
+
+Everything here runs in a fixed number of queries, however many players
+or steps the match has.
+"""
+
+from game.models import Match, PlayerInGame
+from game.skills import skill_names
+
+# Fields that are left out of diffs, as the page does not use them
+HIDDEN_FIELDS = ('home_team_id', 'away_team_id', 'next_position',
+                 'player_id', 'match_id', 'skill_bits', 'dice_seed')
+
+
+def load_match(match_id):
+    """Fetch a match along with both teams and their coaches."""
+    return Match.objects.select_related(
+        'home_team__coach', 'away_team__coach').get(id=match_id)
+
+def serialize_players(match, players=None):
+    """Return every player in the match, home side first.
+
+    Pass the players if they have already been loaded, with their player
+    and position, to avoid fetching them again.
+    """
+    if players is None:
+        players = PlayerInGame.objects.filter(match=match).select_related(
+            'player__position').order_by('-side', 'id')
+    else:
+        players = sorted(players, key=lambda player: player.id)
+        players.sort(key=lambda player: player.side, reverse=True)
+    return [player.as_dict() for player in players]
+
+def team_colors(match):
+    """Pick the colours for each side, avoiding a clash of home kits."""
+    home_team = match.home_team
+    away_team = match.away_team
+    if away_team.color_home_primary == home_team.color_home_primary:
+        color_away_primary = away_team.color_away_primary
+        color_away_secondary = away_team.color_away_secondary
+    else:
+        color_away_primary = away_team.color_home_primary
+        color_away_secondary = away_team.color_home_secondary
+    return {
+        'color_home_primary': home_team.color_home_primary,
+        'color_home_secondary': home_team.color_home_secondary,
+        'color_away_primary': color_away_primary,
+        'color_away_secondary': color_away_secondary,
+    }
+
+def _camel_case(name):
+    words = name.split('_')
+    return words[0] + ''.join(word.title() for word in words[1:])
+
+def serialize_diff(changes):
+    """Turn MatchSession.changes() into the keys used by as_dict().
+
+    Only the changed fields are included, with players identified by their
+    side and number.
+    """
+    diff = {}
+    for obj, changed in changes:
+        fields = {}
+        for name, value in changed.items():
+            if name in HIDDEN_FIELDS:
+                continue
+            if name == 'skills':
+                value = value.split(',')
+            elif name == 'effect_bits':
+                name, value = 'effects', skill_names(value)
+            fields[_camel_case(name)] = value
+        if not fields:
+            continue
+        if isinstance(obj, Match):
+            diff['match'] = fields
+        else:
+            fields['side'] = obj.side
+            fields['num'] = obj.number
+            diff.setdefault('players', []).append(fields)
+    return diff
+
+def serialize_match(match, players=None):
+    """Return the current state of the match and its players."""
+    return {
+        'match': match.as_dict(),
+        'players': serialize_players(match, players),
+        'colors': team_colors(match),
+    }
@@ -0,0 +1,157 @@
+"""Load a match once per request and write back only what changed.
+
+A MatchSession is a small unit of work around one match: the match and all
+of its players are loaded up front in a fixed number of queries, every
+step in the request works on those same objects, and flush() saves just
+the fields that were modified, in a single transaction.
+"""
+
+from collections import defaultdict
+
+from django.db import transaction
+
+from game.models import Formation, Match, PlayerInGame, Step, field_values
+from game.models import formation_placements, formation_positions
+from game.models import save_formation
+from game.pitch import Pitch
+
+
+class MatchSession(object):
+    """Identity map of a match and its players, with dirty tracking."""
+
+    def __init__(self, match_id, lock=False):
+        matches = Match.objects.select_related(
+            'home_team__coach', 'away_team__coach')
+        if lock:
+            # Hold the match row until the surrounding transaction ends
+            matches = matches.select_for_update()
+        self.match = matches.get(id=match_id)
+        self.players = {}
+        for player in PlayerInGame.objects.filter(
+                match=self.match).select_related(
+                'player__position').order_by('id'):
+            # Share our match instance rather than fetching it again
+            player.match = self.match
+            self.players[(player.side, player.number)] = player
+        self._original = {}
+        for obj in self.objects():
+            self._original[self._key(obj)] = field_values(obj)
+        # Formations saved by steps, as [number, depth, ypos], until flush()
+        self._formations = {}
+
+    @staticmethod
+    def _key(obj):
+        return (obj.__class__, obj.pk)
+
+    def objects(self):
+        """Every object that this session is tracking."""
+        return [self.match] + list(self.players.values())
+
+    def player(self, side, num):
+        """Return the player with the given number on the given side."""
+        return self.players[(side, int(num))]
+
+    def pitch(self):
+        """Build the pitch from the players as they stand now."""
+        return Pitch(self.players.values())
+
+    def previous_result(self):
+        """Return the result of the step before the one being resolved."""
+        step = Step.objects.get(
+            match=self.match, history_position=self.match.next_position - 2)
+        return step.as_dict()['result']
+
+    def previous_step(self, position, ignore=()):
+        """Return the last step before `position` as a dict, passing
+        over any of the step types in `ignore`, or None."""
+        steps = Step.objects.filter(
+            match=self.match, history_position__lt=position).exclude(
+            step_type__in=ignore).order_by('-history_position')[:1]
+        if not steps:
+            return None
+        return steps[0].as_dict()
+
+    def formation_placements(self, side, name):
+        """Return a side's saved formation as [number, xpos, ypos]."""
+        if (side, name) in self._formations:
+            return formation_placements(
+                self.match, side, self._formations[(side, name)])
+        formation = Formation.objects.get(
+            team=self.match.team(side), name=name)
+        return formation.placements(self.match, side)
+
+    def save_formation(self, side, name, placements):
+        """Keep a formation for flush() to save."""
+        self._formations[(side, name)] = formation_positions(
+            self.match, side, placements)
+
+    def changed_fields(self, obj):
+        """Return the names of the fields modified since the last flush."""
+        original = self._original[self._key(obj)]
+        return [name for name, value in original.items()
+                if getattr(obj, name) != value]
+
+    def values(self):
+        """Return the current field values of every tracked object."""
+        return {self._key(obj): field_values(obj) for obj in self.objects()}
+
+    def revert(self, values):
+        """Put every tracked object back as values() gave it."""
+        for obj in self.objects():
+            for name, value in values[self._key(obj)].items():
+                setattr(obj, name, value)
+
+    def changes(self, values):
+        """Return each object modified since values() gave `values`.
+
+        Each object comes with a dict of its changed fields and their new
+        values.
+        """
+        changes = []
+        for obj in self.objects():
+            before = values[self._key(obj)]
+            changed = {name: value for name, value in field_values(obj).items()
+                       if before[name] != value}
+            if changed:
+                changes.append((obj, changed))
+        return changes
+
+    def flush(self):
+        """Save every modified field in a single transaction.
+
+        Changes are written set-wise rather than object by object: every
+        field value goes out in one UPDATE for all the objects it applies
+        to, so a change to a whole team costs a few statements. Formations
+        saved by steps are written here too.
+        """
+        # Find the objects that each new field value applies to
+        targets = defaultdict(list)
+        for obj in self.objects():
+            for name in self.changed_fields(obj):
+                targets[(obj.__class__, name, getattr(obj, name))].append(
+                    obj.pk)
+        # Values that apply to the same objects can share a statement
+        updates = defaultdict(dict)
+        for (model, name, value), pks in targets.items():
+            updates[(model, tuple(sorted(pks)))][name] = value
+        with transaction.atomic():
+            for (model, pks), values in updates.items():
+                model.objects.filter(pk__in=pks).update(**values)
+            for (side, name), positions in self._formations.items():
+                save_formation(self.match.team(side), name, positions)
+        self._formations = {}
+        for obj in self.objects():
+            self._original[self._key(obj)] = field_values(obj)
+
+    def restore(self, state):
+        """Put the match and players back to a saved state.
+
+        Nothing is saved until flush() is called.
+        """
+        for name, value in state['match'].items():
+            setattr(self.match, name, value)
+        players = {player.pk: player for player in self.players.values()}
+        for pk, values in state['players'].items():
+            player = players[int(pk)]
+            for name, value in values.items():
+                setattr(player, name, value)
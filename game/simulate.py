@@ -0,0 +1,264 @@
+"""Monte Carlo rollouts of a drive from a match's current position.
+
+Each rollout plays the match on a copy of an Engine, so every roll goes
+through the same game.steps rules as a real match. The dice are not rolled
+one at a time. For a whole batch of rollouts they are drawn up front as an
+array of 32-bit words, with NumPy if it is installed, and turned into dice
+the way game.dice does.
+
+A policy chooses the steps. It is called with the engine and returns the
+next (step_type, data) for the side whose turn it is, or None to end the
+turn. The simulator handles what the page would do after a failed roll:
+knock the player over, scatter a dropped ball and end the turn.
+"""
+
+import random
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from game.dice import die
+from game.steps import on_pitch, other_side
+
+# Words drawn for each rollout up front, and then each time it runs out
+WORDS_PER_ROLLOUT = 64
+# A policy that never ends its turn is stopped after this many steps
+MAX_STEPS_PER_TURN = 100
+
+
+class WordDice(object):
+    """Dice read from a list of pre-drawn random 32-bit words."""
+
+    def __init__(self, words, refill):
+        self._words = words
+        self._refill = refill
+
+    def roll(self, n_sides):
+        if not self._words:
+            self._words = self._refill()
+        return die(self._words.pop(), n_sides)
+
+
+class DiceSource(object):
+    """Draws the words for a batch of rollouts in one go."""
+
+    def __init__(self, seed=None):
+        if numpy is not None:
+            self._random = numpy.random.RandomState(seed)
+        else:
+            self._random = random.Random(seed)
+
+    def words(self, n_rollouts, n_words):
+        """Return `n_rollouts` lists of `n_words` words."""
+        if numpy is not None:
+            return self._random.randint(
+                0, 1 << 32, size=(n_rollouts, n_words),
+                dtype=numpy.uint64).tolist()
+        bits = self._random.getrandbits
+        return [[bits(32) for i in range(n_words)]
+                for j in range(n_rollouts)]
+
+    def dice(self, words):
+        """Return dice for one rollout, starting from `words`."""
+        return WordDice(words, lambda: self.words(1, WORDS_PER_ROLLOUT)[0])
+
+
+def _distance(xpos, ypos, target):
+    x1, y1 = target
+    if y1 is None:
+        return abs(xpos - x1)
+    return max(abs(xpos - x1), abs(ypos - y1))
+
+def path_towards(engine, player, target, length):
+    """Return a path of up to `length` squares that heads for `target`.
+
+    Each square is the free neighbouring square nearest the target, in
+    the fewest opposing tackle zones, and then the straightest. A target
+    of (x, None) is a column, such as an end zone.
+    """
+    pitch = engine.pitch()
+    xpos, ypos = player.xpos, player.ypos
+    path = []
+    while len(path) < length and _distance(xpos, ypos, target) > 0:
+        options = []
+        for x1 in range(xpos - 1, xpos + 2):
+            for y1 in range(ypos - 1, ypos + 2):
+                if (on_pitch(x1, y1) and not pitch.is_occupied(x1, y1) and
+                        (x1, y1) not in path):
+                    # Prefer running straight when all else is equal
+                    options.append((
+                        _distance(x1, y1, target),
+                        pitch.tackle_zones_at(player.side, x1, y1),
+                        abs(y1 - ypos), x1, y1))
+        if not options:
+            break
+        distance, zones, swerve, x1, y1 = min(options)
+        if distance >= _distance(xpos, ypos, target):
+            break
+        path.append((x1, y1))
+        xpos, ypos = x1, y1
+    return path
+
+def ball_carrier(engine):
+    for player in engine.players.values():
+        if player.has_ball and player.on_pitch:
+            return player
+    return None
+
+def run_with_ball(engine):
+    """A simple policy: get the ball and run it to the end zone.
+
+    The carrier runs for the end zone, going for it only when that would
+    score. Without the ball, the nearest free player goes to pick it up.
+    The policy does not block, so the other side just stands its ground.
+    """
+    match = engine.match
+    side = match.current_side
+    carrier = ball_carrier(engine)
+    if carrier is not None:
+        if carrier.side != side or carrier.finished_action:
+            return None
+        target = (match.end_zone(other_side(side)), None)
+        length = max(carrier.move_left, 0)
+        if _distance(carrier.xpos, carrier.ypos, target) <= length + 2:
+            length = carrier.move_left + 2
+        player = carrier
+    else:
+        if (match.x_ball is None or
+                not on_pitch(int(match.x_ball), int(match.y_ball))):
+            return None
+        target = (int(match.x_ball), int(match.y_ball))
+        players = [player for player in engine.players.values()
+                   if player.side == side and player.on_pitch and
+                   not player.down and not player.finished_action and
+                   player.move_left > 0]
+        if not players:
+            return None
+        player = min(players, key=lambda player: _distance(
+            player.xpos, player.ypos, target))
+        if (player.xpos, player.ypos) == target:
+            return ('pickUp', {'side': side, 'num': player.number})
+        length = player.move_left
+    path = path_towards(engine, player, target, length)
+    if not path:
+        return None
+    return ('movePath', {'side': side, 'num': player.number,
+                         'action': 'move', 'path': path})
+
+def _scatter(engine, xpos, ypos):
+    """Bounce the ball, letting anyone it lands on try to catch it."""
+    while True:
+        result = engine.resolve(
+            'scatter', {'nScatter': 1, 'x0': xpos, 'y0': ypos})
+        xpos, ypos = result['x1'], result['y1']
+        if not on_pitch(xpos, ypos):
+            # Throw-ins are left to the coaches
+            return
+        player = engine.pitch().player_at(xpos, ypos)
+        if player is None:
+            return
+        result = engine.resolve('catch', {
+            'side': player.side, 'num': player.number, 'accurate': False})
+        if result['success']:
+            return
+
+def _fall(engine, player):
+    """Knock over a player who failed a roll, and bounce the ball."""
+    had_ball = player.has_ball
+    engine.resolve('knockDown', {'side': player.side, 'num': player.number})
+    if had_ball:
+        _scatter(engine, player.xpos, player.ypos)
+
+def play_turn(engine, policy):
+    """Play the current side's turn. Return True for a turnover."""
+    for i in range(MAX_STEPS_PER_TURN):
+        step = policy(engine)
+        if step is None:
+            return False
+        step_type, data = step
+        result = engine.resolve(step_type, data)
+        player = engine.player(data['side'], data['num'])
+        if step_type == 'movePath':
+            if not result['success']:
+                _fall(engine, player)
+                return True
+            if result['squares'] and result['squares'][-1]['pickUp']:
+                step_type = 'pickUp'
+                result = engine.resolve('pickUp', data)
+        if step_type == 'pickUp' and not result['success']:
+            _scatter(engine, player.xpos, player.ypos)
+            return True
+        if scored(engine) is not None:
+            return False
+    return False
+
+def scored(engine):
+    """Return the side that has just scored, if any."""
+    carrier = ball_carrier(engine)
+    if (carrier is not None and not carrier.down and
+            carrier.xpos == engine.match.end_zone(other_side(carrier.side))):
+        return carrier.side
+    return None
+
+def rollout(engine, policy, n_turns):
+    """Play up to `n_turns` turns, stopping at a touchdown."""
+    casualties = sum(player.casualty for player in engine.players.values())
+    knocked_out = sum(player.knocked_out
+                      for player in engine.players.values())
+    outcome = {'touchdown': None, 'turnovers': 0, 'turns': 0}
+    for turn in range(n_turns):
+        side = engine.match.current_side
+        if play_turn(engine, policy):
+            outcome['turnovers'] += 1
+        outcome['turns'] += 1
+        outcome['touchdown'] = scored(engine)
+        engine.resolve('endTurn', {
+            'side': side, 'touchdown': outcome['touchdown'] is not None})
+        if outcome['touchdown'] is not None:
+            break
+    players = engine.players.values()
+    outcome['casualties'] = sum(p.casualty for p in players) - casualties
+    outcome['knockedOut'] = sum(p.knocked_out for p in players) - knocked_out
+    return outcome
+
+def simulate(engine, policy=run_with_ball, n_rollouts=10000, n_turns=1,
+             seed=None):
+    """Play many rollouts from the engine's position and summarise them.
+
+    Returns the fraction of rollouts that ended in a touchdown for each
+    side or had a turnover, and distributions of the turns played and of
+    the casualties and knock-outs caused.
+    """
+    source = DiceSource(seed)
+    touchdowns = Counter()
+    turnovers = 0
+    turns = Counter()
+    casualties = Counter()
+    knocked_out = Counter()
+    for words in source.words(n_rollouts, WORDS_PER_ROLLOUT):
+        copy = engine.copy()
+        copy.dice = source.dice(words)
+        outcome = rollout(copy, policy, n_turns)
+        if outcome['touchdown'] is not None:
+            touchdowns[outcome['touchdown']] += 1
+        turnovers += outcome['turnovers'] > 0
+        turns[outcome['turns']] += 1
+        casualties[outcome['casualties']] += 1
+        knocked_out[outcome['knockedOut']] += 1
+
+    def fractions(counts):
+        return {key: count / n_rollouts
+                for key, count in sorted(counts.items())}
+
+    return {
+        'rollouts': n_rollouts,
+        'touchdown': {side: touchdowns[side] / n_rollouts
+                      for side in ('home', 'away')},
+        'turnover': turnovers / n_rollouts,
+        'turns': fractions(turns),
+        'casualties': fractions(casualties),
+        'knockedOut': fractions(knocked_out),
+    }
@@ -0,0 +1,70 @@
+"""Integer IDs for skills, so that players can hold them as bitsets.
+
+Each skill is one bit, in the order of SKILLS. A player's skills and
+effects are stored as the OR of their bits, so checking for one is a
+single AND. The bits are saved in the database, so new skills must only
+ever be added to the end of the list.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SKILLS = (
+    'Dodge',
+    'Pass',
+    'Catch',
+    'Block',
+    'Safe Throw',
+    'Sure Hands',
+    'Loner',
+    'Bone-head',
+    'Mighty Blow',
+    'Thick Skull',
+    'Throw Team-Mate',
+    'Regeneration',
+    'Decay',
+    'Right Stuff',
+    'Stunty',
+    'Always Hungry',
+    'Really Stupid',
+)
+
+SKILL_BITS = {name: 1 << index for index, name in enumerate(SKILLS)}
+
+DODGE = SKILL_BITS['Dodge']
+PASS = SKILL_BITS['Pass']
+CATCH = SKILL_BITS['Catch']
+BLOCK = SKILL_BITS['Block']
+SURE_HANDS = SKILL_BITS['Sure Hands']
+LONER = SKILL_BITS['Loner']
+BONE_HEAD = SKILL_BITS['Bone-head']
+MIGHTY_BLOW = SKILL_BITS['Mighty Blow']
+THICK_SKULL = SKILL_BITS['Thick Skull']
+REGENERATION = SKILL_BITS['Regeneration']
+REALLY_STUPID = SKILL_BITS['Really Stupid']
+
+
+def skill_bits(skills):
+    """Return the bitset for a comma-separated list of skill names.
+
+    A skill with no bit is skipped and logged, so that one missing from
+    SKILLS cannot stop a match from starting.
+    """
+    bits = 0
+    for name in skills.split(','):
+        if not name:
+            continue
+        if name not in SKILL_BITS:
+            logger.warning('Unrecognised skill: %s', name)
+            continue
+        bits |= SKILL_BITS[name]
+    return bits
+
+def all_recognised(skills):
+    """Whether every skill in a comma-separated list has a bit."""
+    return all(name in SKILL_BITS for name in skills.split(',') if name)
+
+def skill_names(bits):
+    """Return the names of the skills in a bitset."""
+    return [name for name in SKILLS if bits & SKILL_BITS[name]]
@@ -0,0 +1,102 @@
+"""Rebuild a match as it stood at any point in its history.
+
+The state of the match and its players is saved every SNAPSHOT_INTERVAL
+steps and at the end of every turn. To get back to a position, the nearest
+snapshot before it is loaded and only the steps since then are replayed,
+with the dice regenerated from the match's seed.
+"""
+
+import json
+
+from django.db import transaction
+
+from game import broadcast, state_cache
+from game.dice import dice_stream
+from game.models import Match, Snapshot, Step, compact_json
+from game.session import MatchSession
+from game.step_types import parse_step
+from game.steps import recorded_dice, resolve
+
+SNAPSHOT_INTERVAL = 20
+
+
+def is_due(step_type, position):
+    """Whether to take a snapshot once the match reaches `position`."""
+    return step_type == 'endTurn' or position % SNAPSHOT_INTERVAL == 0
+
+def rebuild(match_id, position, lock=False):
+    """Return a session holding the match as it was before `position`.
+
+    The session is not flushed, so the database is left as it is; that
+    includes any formations saved by the replayed steps. Positions before
+    a match's first snapshot cannot be rebuilt and raise ValueError. For
+    matches started before snapshots existed, the snapshot_matches command
+    takes a first one at their current position.
+    """
+    session = MatchSession(match_id, lock=lock)
+    if not 0 <= position <= session.match.next_position:
+        raise ValueError('Match {} has no history position {}'.format(
+            match_id, position))
+    snapshots = Snapshot.objects.filter(
+        match_id=match_id, history_position__lte=position).order_by(
+        '-history_position')[:1]
+    if not snapshots:
+        raise ValueError('Match {} has no snapshot before position {}'.format(
+            match_id, position))
+    snapshot = snapshots[0]
+    session.restore(json.loads(snapshot.state))
+    steps = Step.objects.filter(
+        match_id=match_id, history_position__gte=snapshot.history_position,
+        history_position__lt=position).order_by('history_position')
+    for step in steps:
+        replay(session, step)
+    return session
+
+def replay(session, step):
+    """Resolve a stored step again on the session and return its result.
+
+    The dice are regenerated from the match's seed, or taken from the
+    step's recorded rolls if the match was started without one. A step
+    that has neither never rolls fresh dice: if it rolls at all, it
+    raises ValueError.
+    """
+    session.match.next_position = step.history_position + 1
+    data = parse_step(step.step_type, step.data())
+    if step.rolls:
+        dice = recorded_dice(json.loads(step.rolls))
+    elif session.match.dice_seed is not None:
+        dice = recorded_dice(stream=dice_stream(
+            session.match.dice_seed, step.history_position))
+    else:
+        dice = recorded_dice([])
+    with dice:
+        return resolve(session, step.step_type, data)
+
+def audit(match_id):
+    """Replay a whole match and return the history positions whose stored
+    results differ from the replayed ones."""
+    session = rebuild(match_id, 0)
+    steps = Step.objects.filter(match_id=match_id).order_by(
+        'history_position')
+    mismatches = []
+    for step in steps:
+        result = json.loads(compact_json(replay(session, step)))
+        if result != json.loads(step.result or 'null'):
+            mismatches.append(step.history_position)
+    return mismatches
+
+def rewind(match_id, position):
+    """Discard every step from `position` onwards."""
+    with transaction.atomic():
+        session = rebuild(match_id, position, lock=True)
+        end = Match.objects.values_list(
+            'next_position', flat=True).get(id=match_id)
+        Step.objects.filter(
+            match_id=match_id, history_position__gte=position).delete()
+        Snapshot.objects.filter(
+            match_id=match_id, history_position__gt=position).delete()
+        session.flush()
+    broadcast.retract(match_id, position, end)
+    state_cache.discard(match_id, position + 1, end + 1)
+    state_cache.store(session.match, session.players.values())
+    return session
@@ -3,6 +3,7 @@ from getpass import getpass
 from django.contrib.auth.models import User
 
 from game.models import Race, create_team, PlayerInGame, create_player, start_match
+from game.models import save_snapshot
 
 def create_match():
     # Make the users, if necessary
@@ -75,6 +76,7 @@ def start_after_kickoff():
     match.turn_number = 1
     match.current_side = 'away'
     match.save()
+    save_snapshot(match, match.playeringame_set.all())
     return match
         
 
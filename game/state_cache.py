@@ -0,0 +1,51 @@
+"""Cache the serialized state of each match, keyed by history position.
+
+A match's state only changes when a step is appended, so the state at a
+given position never goes stale. post_step_view writes the new state
+through after every commit, and page loads read it back without touching
+the database.
+"""
+
+from django.core.cache import cache
+
+from game import broadcast
+from game.serializers import load_match, serialize_match
+
+STATE_TIMEOUT = 60 * 60
+
+
+def _state_key(match_id, position):
+    return 'match-state:{}:{}'.format(match_id, position)
+
+def store(match, players=None):
+    """Cache the state of the match as of its latest step."""
+    state = serialize_match(match, players)
+    cache.set(_state_key(match.id, match.next_position), state,
+              STATE_TIMEOUT)
+    return state
+
+def discard(match_id, start, end):
+    """Forget the states from position `start` up to `end`."""
+    cache.delete_many([_state_key(match_id, position)
+                       for position in range(start, end)])
+
+def get_state(match_id, position=None):
+    """Return the serialized state of the match at `position`.
+
+    By default this is the state after its latest step. An earlier state
+    that is not in the cache is rebuilt from the match's snapshots.
+    """
+    latest = broadcast.next_position(match_id)
+    if position is None:
+        position = latest
+    state = cache.get(_state_key(match_id, position))
+    if state is None:
+        if position >= latest:
+            state = store(load_match(match_id))
+        else:
+            # Imported here, as snapshots updates this cache in turn
+            from game.snapshots import rebuild
+            session = rebuild(match_id, position)
+            state = serialize_match(session.match, session.players.values())
+            cache.set(_state_key(match_id, position), state, STATE_TIMEOUT)
+    return state
@@ -0,0 +1,169 @@
+"""The fields that each type of step carries, and their types.
+
+Steps arrive as form data, where everything is a string. parse_step()
+checks a step against the schema for its type and converts each field
+once, so that resolve() and the stored history work with real integers,
+booleans and lists. Fields that are not in the schema are kept as they
+are, as the page uses some of them for its own bookkeeping.
+"""
+
+import json
+
+from game.steps import BLOCK_DICE
+
+
+def side(value):
+    if value not in ('home', 'away'):
+        raise ValueError('Unrecognised side: ' + repr(value))
+    return value
+
+def integer(value):
+    if value in ('', None):
+        raise ValueError('Not an integer: ' + repr(value))
+    return int(value)
+
+def boolean(value):
+    if value in (True, 'true'):
+        return True
+    elif value in (False, 'false'):
+        return False
+    raise ValueError('Not a boolean: ' + repr(value))
+
+def text(value):
+    return str(value)
+
+def json_value(value):
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+def block_face(value):
+    if value not in BLOCK_DICE.values():
+        raise ValueError('Unrecognised block dice: ' + repr(value))
+    return value
+
+def mighty_blow(value):
+    if value in ('armour', 'injury'):
+        return value
+    return boolean(value)
+
+
+class optional(object):
+    """Mark a field that a step may leave out or leave empty.
+
+    An empty value becomes None, as jQuery sends null as an empty string,
+    so that it stays distinct from False or 0.
+    """
+
+    def __init__(self, convert):
+        self.convert = convert
+
+    def __call__(self, value):
+        if value in ('', None):
+            return None
+        return self.convert(value)
+
+
+# Fields that any step may carry
+COMMON_FIELDS = {
+    'side': optional(side),
+    'num': optional(integer),
+    'action': optional(text),
+    'x0': optional(integer),
+    'y0': optional(integer),
+    'x1': optional(integer),
+    'y1': optional(integer),
+    'xpos': optional(integer),
+    'ypos': optional(integer),
+    'targetNum': optional(integer),
+    'targetSide': optional(side),
+    'oldSide': optional(side),
+    'goForIt': optional(boolean),
+    'turnover': optional(boolean),
+    'potentialTurnover': optional(boolean),
+    'bounceAgain': optional(boolean),
+}
+
+PLAYER = {'side': side, 'num': integer}
+PLAYER_ACTION = dict(PLAYER, action=text)
+TARGET = dict(PLAYER_ACTION, targetNum=integer)
+DESTINATION = {'x1': integer, 'y1': integer}
+
+SCHEMAS = {
+    'move': dict(PLAYER_ACTION, dodge=boolean, **DESTINATION),
+    'push': dict(PLAYER, offPitch=boolean, **DESTINATION),
+    'followUp': dict(PLAYER, choice=boolean),
+    'movePath': dict(PLAYER_ACTION, path=json_value),
+    'block': TARGET,
+    'selectBlockDice': {'selectedDice': optional(block_face)},
+    'resolveBlock': dict(PLAYER, targetNum=integer, selectedDice=block_face,
+                         pushPath=optional(json_value),
+                         followUp=optional(boolean)),
+    'foul': TARGET,
+    'knockDown': dict(PLAYER, mightyBlow=optional(mighty_blow),
+                      perpNum=optional(integer), perpSide=optional(side)),
+    'standUp': PLAYER_ACTION,
+    'pickUp': PLAYER,
+    'scatter': {'nScatter': integer, 'x0': integer, 'y0': integer},
+    'catch': dict(PLAYER, accurate=boolean),
+    'pass': dict(PLAYER_ACTION, x0=integer, y0=integer, **DESTINATION),
+    'handOff': dict(PLAYER_ACTION, **DESTINATION),
+    'throwin': {'lastX': integer, 'lastY': integer},
+    'goForIt': {},
+    'endTurn': {'touchdown': optional(boolean)},
+    'setKickoff': {'kickingTeam': side},
+    'placeBall': DESTINATION,
+    'placePlayer': dict(PLAYER, subs=optional(boolean)),
+    'submitPlayers': {},
+    'submitFormation': {'side': side, 'formationName': optional(text),
+                        'formation': optional(json_value),
+                        'saveAs': optional(text)},
+    'submitBall': {},
+    'touchback': dict(PLAYER, **DESTINATION),
+    'submitTouchback': {'touchback': optional(boolean)},
+    'endKickoff': {'touchback': optional(boolean)},
+    'bonehead': PLAYER_ACTION,
+    'reallyStupid': PLAYER_ACTION,
+}
+
+REROLL_FIELDS = {
+    'rerollType': text,
+    'rerollStepType': text,
+    'rerollSkill': optional(text),
+}
+
+
+def schema(step_type, data):
+    """Return the fields for a step of the given type."""
+    if step_type == 'reroll':
+        # A reroll repeats another step, so it carries that step's fields
+        rerolled = data.get('rerollStepType')
+        if rerolled == 'reroll' or rerolled not in SCHEMAS:
+            raise ValueError('Cannot reroll a step of type: ' +
+                             repr(rerolled))
+        fields = dict(SCHEMAS[rerolled], **REROLL_FIELDS)
+    elif step_type in SCHEMAS:
+        fields = SCHEMAS[step_type]
+    else:
+        raise ValueError('Unrecognised step type: ' + repr(step_type))
+    return dict(COMMON_FIELDS, **fields)
+
+def parse_step(step_type, data):
+    """Check a step's data and convert each field to its proper type.
+
+    Raises ValueError if a field is missing or cannot be converted.
+    """
+    fields = schema(step_type, data)
+    parsed = {}
+    for name, value in data.items():
+        if name in fields:
+            try:
+                value = fields[name](value)
+            except ValueError as error:
+                raise ValueError('Bad value for {}: {}'.format(name, error))
+        parsed[name] = value
+    for name, convert in fields.items():
+        if name not in parsed and not isinstance(convert, optional):
+            raise ValueError('Missing field for {}: {}'.format(
+                step_type, name))
+    return parsed
@@ -1,40 +1,31 @@
-from game.models import PlayerInGame, Step, set_kickoff
+from game import skills
+from game.models import Formation, set_kickoff
 
 import random
+import threading
+from contextlib import contextmanager
 
-def find_player(match, data):
+def find_player(session, data):
     """Find out which player it is."""
-    if data['side'] == 'home':
-        team = match.home_team
-    elif data['side'] == 'away':
-        team = match.away_team
-    num = data['num']
-    player = PlayerInGame.objects.get(
-        match=match, player__team=team, player__number=num)
-    return player
-
-def finish_previous_action(match, current_player):
-    active_steps = ['move', 'block', 'standUp', 'pass', 'foul', 'handOff']
-    step_set = Step.objects.filter(match=match).order_by('-history_position')
-    for step in step_set:
-        if step is step_set[0]:
-            continue
-        if step.step_type == 'endTurn':
-            return
-        if step.step_type in active_steps:
-            player = find_player(match, step.as_dict())
-            if (player.side == current_player.side and 
-                    player.player.number == current_player.player.number):
-                continue
+    return session.player(data['side'], data['num'])
+
+def finish_previous_action(session, current_player):
+    """Finish the action of the last player to act, if it was someone else."""
+    match = session.match
+    if match.active_num is not None:
+        player = session.player(match.active_side, match.active_num)
+        if player is not current_player:
             player.finished_action = True
-            player.save()
+    match.active_side = current_player.side
+    match.active_num = current_player.number
 
-def set_action(player, action):
+def set_action(session, player, action):
     player.action = action
-    player.save()
-    finish_previous_action(player.match, player)
+    finish_previous_action(session, player)
 
-def resolve(match, step_type, data):
+def resolve(session, step_type, data):
+    """Carry out a step, leaving the changes in the session to be saved."""
+    match = session.match
     result = {}
     if step_type == 'reroll':
         if data['rerollType'] == 'team':
@@ -44,28 +35,27 @@ def resolve(match, step_type, data):
             else:
                 match.away_rerolls -= 1
                 match.away_reroll_used_this_turn = True
-            match.save()
-        player = find_player(match, data)
-        if player.has_skill('Loner'):
+        player = find_player(session, data)
+        if player.has_skill(skills.LONER):
             loner_dice = roll_dice(6, 1)
             loner_success = loner_dice['dice'][0] >= 4
             loner_dict = {'dice': loner_dice, 'success': loner_success}
             result.update({'loner': loner_dict})
             if not loner_success:
                 # Copy the results of the last attempt and return now
-                result.update(previous_step(match, data).as_dict()['result'])
+                result.update(session.previous_result())
                 return result
         step_type = data['rerollStepType']
     if step_type in ['move', 'push', 'followUp']:
         # A move step
-        if step_type == 'followUp' and data['choice'] == 'false':
+        if step_type == 'followUp' and not data['choice']:
             return {}
-        player = find_player(match, data)
+        player = find_player(session, data)
         if step_type == 'move':
-            set_action(player, data['action'])
+            set_action(session, player, data['action'])
         # Update the player's position in the database
-        player.xpos = int(data['x1'])
-        player.ypos = int(data['y1'])
+        player.xpos = data['x1']
+        player.ypos = data['y1']
         if step_type == 'move':
             player.move_left -= 1
             if player.move_left == -2:
@@ -74,8 +64,7 @@ def resolve(match, step_type, data):
             # Move the ball too
             match.x_ball = data['x1']
             match.y_ball = data['y1']
-            match.save()
-        if step_type == 'push' and data['offPitch'] == 'true':
+        if step_type == 'push' and data['offPitch']:
             player.on_pitch = False
             injury_roll = roll_injury_dice(player)
             if injury_roll['result'] == 'knockedOut':
@@ -83,64 +72,38 @@ def resolve(match, step_type, data):
             elif injury_roll['result'] == 'casualty':
                 player.casualty = True
             result.update({'injuryRoll': injury_roll})
-        elif step_type == 'move' and data['dodge'] == 'true':
-            modifier = 1 - n_tackle_zones(player)
+        elif step_type == 'move' and data['dodge']:
+            modifier = 1 - session.pitch().n_tackle_zones(player)
             result.update(roll_agility_dice(player, modifier=modifier))
         else:
             result.update({'success': True})
-        player.save()
+        return result
+    elif step_type == 'movePath':
+        # A whole path of move steps, resolved one square at a time
+        player = find_player(session, data)
+        set_action(session, player, data['action'])
+        pitch = session.pitch()
+        squares = []
+        for x1, y1 in data['path']:
+            square_result = move_square(match, pitch, player, int(x1), int(y1))
+            squares.append(square_result)
+            if not square_result['success'] or square_result['pickUp']:
+                # Stop so the client can handle the fall or the pick-up
+                break
+        result['squares'] = squares
+        result['success'] = all(s['success'] for s in squares)
         return result
     elif step_type == 'block':
         # A block step
-        # Find out which is the attacking player
-        if data['side'] == 'home':
-            attacking_team = match.home_team
-            defending_team = match.away_team
-        elif data['side'] == 'away':
-            attacking_team = match.away_team
-            defending_team = match.home_team
-        attacking_num = int(data['num'])
-        defending_num = int(data['targetNum'])
-        attacking_player = PlayerInGame.objects.get(
-            match=match, player__team=attacking_team, 
-            player__number=attacking_num)
-        set_action(attacking_player, data['action'])
-        defending_player = PlayerInGame.objects.get(
-            match=match, player__team=defending_team,
-            player__number=defending_num)
-        attack_st = attacking_player.player.st
-        for player in PlayerInGame.objects.filter(
-            match=match, player__team=attacking_team,
-            xpos__gt=(defending_player.xpos-2),
-            xpos__lt=(defending_player.xpos+2),
-            ypos__gt=(defending_player.ypos-2),
-            ypos__lt=(defending_player.ypos+2),
-            on_pitch=True, down=False, tackle_zones=True):
-            if (player != attacking_player and 
-                    n_tackle_zones(player) == 
-                    int(defending_player.tackle_zones)):
-                attack_st += 1
-        defence_st = defending_player.player.st
-        for player in PlayerInGame.objects.filter(
-            match=match, player__team=defending_team,
-            xpos__gt=(attacking_player.xpos-2),
-            xpos__lt=(attacking_player.xpos+2),
-            ypos__gt=(attacking_player.ypos-2),
-            ypos__lt=(attacking_player.ypos+2),
-            on_pitch=True, down=False, tackle_zones=True):
-            if (player != defending_player and 
-                    n_tackle_zones(player) ==
-                    int(attacking_player.tackle_zones)):
-                defence_st += 1
-        n_dice = 1
-        if attack_st > (2 * defence_st):
-            n_dice = 3
-        elif attack_st > defence_st:
-            n_dice = 2
-        elif (2 * attack_st) < defence_st:
-            n_dice = 3
-        elif attack_st < defence_st:
-            n_dice = 2
+        # Find out which are the attacking and defending players
+        attacking_player = find_player(session, data)
+        set_action(session, attacking_player, data['action'])
+        defending_player = session.player(
+            other_side(data['side']), data['targetNum'])
+        pitch = session.pitch()
+        attack_st = block_strength(pitch, attacking_player, defending_player)
+        defence_st = block_strength(pitch, defending_player, attacking_player)
+        n_dice = n_block_dice(attack_st, defence_st)
         result.update(roll_block_dice(n_dice))
         result['attackSt'] = attack_st
         result['defenceSt'] = defence_st
@@ -148,66 +111,37 @@ def resolve(match, step_type, data):
             attacking_player.move_left -= 1
         if attacking_player.move_left == -2 or data['action'] != "blitz":
             attacking_player.finished_action = True
-        attacking_player.save()
         return result
     elif step_type == 'selectBlockDice':
         return result
+    elif step_type == 'resolveBlock':
+        # Everything after the block dice have been chosen, in one step
+        attacking_player = find_player(session, data)
+        defending_player = session.player(
+            other_side(data['side']), data['targetNum'])
+        check_block_choice(session, data, attacking_player, defending_player)
+        result.update(resolve_block(
+            session, attacking_player, defending_player,
+            data['selectedDice'], data.get('pushPath') or [],
+            data.get('followUp', False)))
+        return result
     elif step_type == 'foul':
         # A foul on a player
-        # Find out which is the attacking player
-        if data['side'] == 'home':
-            attacking_team = match.home_team
-            defending_team = match.away_team
-        elif data['side'] == 'away':
-            attacking_team = match.away_team
-            defending_team = match.home_team
-        attacking_num = int(data['num'])
-        defending_num = int(data['targetNum'])
-        attacking_player = PlayerInGame.objects.get(
-            match=match, player__team=attacking_team, 
-            player__number=attacking_num)
-        set_action(attacking_player, data['action'])
-        defending_player = PlayerInGame.objects.get(
-            match=match, player__team=defending_team,
-            player__number=defending_num)
-        modifier = 0
-        for player in PlayerInGame.objects.filter(
-            match=match, player__team=attacking_team,
-            xpos__gt=(defending_player.xpos-2),
-            xpos__lt=(defending_player.xpos+2),
-            ypos__gt=(defending_player.ypos-2),
-            ypos__lt=(defending_player.ypos+2),
-            on_pitch=True, down=False, tackle_zones=True):
-            if player != attacking_player and n_tackle_zones(player) == 0:
-                modifier += 1
-        for player in PlayerInGame.objects.filter(
-            match=match, player__team=defending_team,
-            xpos__gt=(attacking_player.xpos-2),
-            xpos__lt=(attacking_player.xpos+2),
-            ypos__gt=(attacking_player.ypos-2),
-            ypos__lt=(attacking_player.ypos+2),
-            on_pitch=True, down=False, tackle_zones=True):
-            if (player != defending_player and
-                    n_tackle_zones(player) ==
-                    int(attacking_player.tackle_zones)):
-                modifier -= 1
+        # Find out which are the attacking and defending players
+        attacking_player = find_player(session, data)
+        set_action(session, attacking_player, data['action'])
+        defending_player = session.player(
+            other_side(data['side']), data['targetNum'])
+        pitch = session.pitch()
+        modifier = pitch.n_assists(attacking_player, defending_player, 0)
+        modifier -= pitch.n_assists(
+            defending_player, attacking_player,
+            int(attacking_player.tackle_zones))
         # Roll against armour
         armour_roll = roll_armour_dice(defending_player, modifier)
         if armour_roll['success']:
             injury_roll = roll_injury_dice(defending_player)
-            if injury_roll['result'] == 'stunned':
-                defending_player.stunned = True
-                defending_player.stunned_this_turn = True
-            elif injury_roll['result'] == 'knockedOut':
-                defending_player.knocked_out = True
-                defending_player.on_pitch = False
-            elif injury_roll['result'] == 'casualty':
-                defending_player.casualty = True
-                defending_player.on_pitch = False
-            else:
-                raise ValueError('Injury roll returned unexpected result: ' + 
-                                 injury_roll['result'])
-            defending_player.save()
+            apply_injury(defending_player, injury_roll)
         else:
             injury_roll = None
         sent_off = (is_double(armour_roll['dice']) or 
@@ -217,51 +151,24 @@ def resolve(match, step_type, data):
             attacking_player.sent_off = True
             attacking_player.on_pitch = False
         attacking_player.finished_action = True    
-        attacking_player.save()
         result.update({'armourRoll': armour_roll, 'injuryRoll': injury_roll, 
                        'sentOff': sent_off})
         return result
     elif step_type == 'knockDown':
         # A player knocked over
-        player = find_player(match, data)
-        # Knock the player over in the database
-        player.down = True
-        player.tackle_zones = False
-        player.has_ball = False
-        player.save()
+        player = find_player(session, data)
         # Check for Mighty Blow skill
-        mighty_blow = data.get('mightyBlow', False)
-        # Roll against armour
-        modifier = 1 if mighty_blow == 'armour' else 0
-        armour_roll = roll_armour_dice(player, modifier=modifier)
-        if armour_roll['success']:
-            modifier = 1 if mighty_blow == 'injury' else 0
-            injury_roll = roll_injury_dice(player, modifier=modifier)
-            if injury_roll['result'] == 'stunned':
-                player.stunned = True
-                player.stunned_this_turn = True
-            elif injury_roll['result'] == 'knockedOut':
-                player.knocked_out = True
-                player.on_pitch = False
-            elif injury_roll['result'] == 'casualty':
-                player.casualty = True
-                player.on_pitch = False
-            else:
-                raise ValueError('Injury roll returned unexpected result: ' + 
-                                 injury_roll['result'])
-            player.save()
-        else:
-            injury_roll = None
-        result.update({'armourRoll': armour_roll, 'injuryRoll': injury_roll})
+        mighty_blow = data.get('mightyBlow') or False
+        result.update(knock_down(player, mighty_blow))
         return result
     elif step_type == 'standUp':
         # A player standing up
-        player = find_player(match, data)
-        set_action(player, data['action'])
+        player = find_player(session, data)
+        set_action(session, player, data['action'])
         player.move_left -= 3
         if player.move_left <= -2:
             player.finished_action = True
-        if player.player.ma < 3:
+        if player.ma < 3:
             dice = roll_dice(6, 1)
             success = dice['dice'][0] >= 4
         else:
@@ -270,24 +177,22 @@ def resolve(match, step_type, data):
         if success:
             player.down = False
             player.tackle_zones = True
-        player.save()
         result.update({'dice': dice, 'success': success})
         return result
     elif step_type == 'pickUp':
         # A player picking up the ball
-        player = find_player(match, data)
-        modifier = 1 - n_tackle_zones(player)
+        player = find_player(session, data)
+        modifier = 1 - session.pitch().n_tackle_zones(player)
         result.update(roll_agility_dice(player, modifier=modifier))
         if result['success']:
             player.has_ball = True
-            player.save()
         return result
     elif step_type == 'scatter':
         # Scattering the ball
-        n_scatter = int(data['nScatter'])
+        n_scatter = data['nScatter']
         dice = roll_dice(8, n_scatter)
-        x_ball = int(data['x0'])
-        y_ball = int(data['y0'])
+        x_ball = data['x0']
+        y_ball = data['y0']
         for direction in dice['dice']:
             last_x = x_ball
             last_y = y_ball
@@ -303,30 +208,28 @@ def resolve(match, step_type, data):
                 break
         match.x_ball = x_ball
         match.y_ball = y_ball
-        match.save()
         result.update({'dice': dice, 'direction': direction, 
                        'x1': x_ball, 'y1': y_ball,
                        'lastX': last_x, 'lastY': last_y})
         return result
     elif step_type == 'catch':
         # Catching the ball
-        player = find_player(match, data)
-        if player.down or player.affected('Bone-head'):
+        player = find_player(session, data)
+        if player.down or player.affected(skills.BONE_HEAD):
             return {'success': False}
-        modifier = - n_tackle_zones(player)
-        if data['accurate'] == 'true':
+        modifier = - session.pitch().n_tackle_zones(player)
+        if data['accurate']:
             modifier += 1
         result.update(roll_agility_dice(player, modifier=modifier))
         if result['success']:
             player.has_ball = True
-            player.save()
         return result
     elif step_type == 'pass':
         # Pass the ball
-        player = find_player(match, data)
-        set_action(player, data['action'])
-        delta_x = abs(int(data['x1']) - int(data['x0']))
-        delta_y = abs(int(data['y1']) - int(data['y0']))
+        player = find_player(session, data)
+        set_action(session, player, data['action'])
+        delta_x = abs(data['x1'] - data['x0'])
+        delta_y = abs(data['y1'] - data['y0'])
         pass_range = find_pass_range(delta_x, delta_y)
         if pass_range == 'quickPass':
             modifier = 1
@@ -336,36 +239,32 @@ def resolve(match, step_type, data):
             modifier = -1
         elif pass_range == 'longBomb':
             modifier = -2
-        modifier -= n_tackle_zones(player)
+        modifier -= session.pitch().n_tackle_zones(player)
         result.update(roll_agility_dice(player, modifier=modifier))
         fumble = (min(result['rawResult'], result['modifiedResult']) <= 1)
         if fumble:
             result['success'] = False
         else:
-            match.x_ball = int(data['x1'])
-            match.y_ball = int(data['y1'])
-            match.save()
+            match.x_ball = data['x1']
+            match.y_ball = data['y1']
             result['x1'] = match.x_ball
             result['y1'] = match.y_ball
         result['fumble'] = fumble
         player.has_ball = False
         player.finished_action = True
-        player.save()
         return result
     elif step_type == 'handOff':
         # Hand-Off the ball to an adjacent player
         # Always successful
-        player = find_player(match, data)
-        set_action(player, data['action'])
+        player = find_player(session, data)
+        set_action(session, player, data['action'])
         player.finished_action = True
-        player.save()
-        match.x_ball = int(data['x1'])
-        match.y_ball = int(data['y1'])
-        match.save()
+        match.x_ball = data['x1']
+        match.y_ball = data['y1']
         return result
     elif step_type == 'throwin':
-        x0 = int(data['lastX'])
-        y0 = int(data['lastY'])
+        x0 = data['lastX']
+        y0 = data['lastY']
         if y0 == 0:
             edge = 0
         elif y0 == 14:
@@ -416,8 +315,11 @@ def resolve(match, step_type, data):
     elif step_type == 'endTurn':
         match.home_reroll_used_this_turn = False
         match.away_reroll_used_this_turn = False
+        match.active_side = ''
+        match.active_num = None
+        match.turn_start_position = match.next_position
         skip_turn = False
-        if 'touchdown' in data and data['touchdown'] == 'true':
+        if data.get('touchdown'):
             if data['side'] == 'home':
                 match.home_score += 1
             else:
@@ -444,55 +346,67 @@ def resolve(match, step_type, data):
         # if ('touchdown' in data and data['touchdown'] == 'true' and 
         #     not end_of_half):
         #     set_kickoff(match, data['side'])
-        match.save()
-        for player in PlayerInGame.objects.filter(match=match):
+        for player in session.players.values():
             player.move_left = player.ma
             player.action = ''
             player.finished_action = False
-            if (player.player.team == match.team(match.current_side)
+            if (player.side == match.current_side
                 and player.stunned and not player.stunned_this_turn):
                 player.stunned = False
             player.stunned_this_turn = False
-            player.save()
         return result
     elif step_type == 'setKickoff':
         revive_result = {'revived': [], 'knockedOut': []}
-        for player in PlayerInGame.objects.filter(
-                match=match, knocked_out=True):
+        for player in session.players.values():
+            if not player.knocked_out:
+                continue
             dice = roll_dice(6, 1)
-            player_data = {'side': player.side, 'num': player.player.number,
+            player_data = {'side': player.side, 'num': player.number,
                            'dice': dice}
             if dice['dice'][0] >= 4:
                 revive_result['revived'].append(player_data)
                 player.knocked_out = False
-                player.save()
             else:
                 revive_result['knockedOut'].append(player_data)
-        set_kickoff(match, data['kickingTeam'])
-        match.save()
+        set_kickoff(match, data['kickingTeam'], session.players.values())
         result.update(revive_result)
         return result
     elif step_type == 'placeBall':
-        match.x_ball = int(data['x1'])
-        match.y_ball = int(data['y1'])
-        match.save()
+        match.x_ball = data['x1']
+        match.y_ball = data['y1']
         return result
     elif step_type == 'placePlayer':
-        player = find_player(match, data)
-        if 'subs' in data and data['subs'] == 'true':
+        player = find_player(session, data)
+        if data.get('subs'):
             player.on_pitch = False
         else:
-            player.xpos = int(data['x1'])
-            player.ypos = int(data['y1'])
+            player.xpos = data['x1']
+            player.ypos = data['y1']
             player.on_pitch = True
-        player.save()
         return result
     elif step_type == 'submitPlayers':
-        match.n_to_place -= 1
-        if match.n_to_place == 0:
-            match.turn_type = 'placeBall'
-        match.current_side = other_side(match.current_side)
-        match.save()
+        submit_players(match)
+        return result
+    elif step_type == 'submitFormation':
+        # Place a whole side at once, then submit them
+        if match.turn_type != 'placePlayers':
+            raise ValueError('Players are not being placed')
+        if data['side'] != match.current_side:
+            raise ValueError('Not the side placing players: ' + data['side'])
+        if data.get('formationName'):
+            try:
+                placements = session.formation_placements(
+                    data['side'], data['formationName'])
+            except Formation.DoesNotExist:
+                raise ValueError('No such formation: ' +
+                                 data['formationName'])
+        else:
+            placements = data['formation']
+        placements = place_formation(session, data['side'], placements)
+        if data.get('saveAs'):
+            session.save_formation(data['side'], data['saveAs'], placements)
+        submit_players(match)
+        result['placements'] = placements
         return result
     elif step_type == 'submitBall':
         distance_dice = roll_dice(6, 1)
@@ -517,53 +431,41 @@ def resolve(match, step_type, data):
         else:
             match.x_ball = x_ball
             match.y_ball = y_ball
-        match.save()
         result.update({'dice': direction_dice, 'direction': direction, 
                        'distanceDice': distance_dice, 'distance': distance,
                        'x1': x_ball, 'y1': y_ball})
         return result
     elif step_type == 'touchback':
-        match.x_ball = int(data['x1'])
-        match.y_ball = int(data['y1'])
-        match.save()
-        for player in match.playeringame_set.all():
+        match.x_ball = data['x1']
+        match.y_ball = data['y1']
+        for player in session.players.values():
             player.has_ball = False
-            player.save()
-        player = find_player(match, data)
+        player = find_player(session, data)
         player.has_ball = True
-        player.save()
         return result
     elif step_type == 'submitTouchback' or step_type == 'endKickoff':
         match.turn_type = 'normal'
-        if 'touchback' in data and data['touchback'] == 'false':
+        if data.get('touchback') is False:
             match.current_side = other_side(match.current_side)
-        match.save()
         return result
     elif step_type == 'bonehead':
-        player = find_player(match, data)
-        set_action(player, data['action'])
+        player = find_player(session, data)
+        set_action(session, player, data['action'])
         result.update(roll_dice(6, 1))
         result['success'] = (result['dice'][0] != 1)
         if result['success']:
             player.tackle_zones = True
-            player.remove_effect('Bone-head')
+            player.remove_effect(skills.BONE_HEAD)
         else:
             player.tackle_zones = False
-            player.add_effect('Bone-head')
+            player.add_effect(skills.BONE_HEAD)
             player.finished_action = True
-        player.save()
         return result
     elif step_type == 'reallyStupid':
-        player = find_player(match, data)
-        set_action(player, data['action'])
+        player = find_player(session, data)
+        set_action(session, player, data['action'])
         result.update(roll_dice(6, 1))
-        n_helpers = PlayerInGame.objects.filter(
-            match=match, player__team=player.team,
-            xpos__gt=(player.xpos-2),
-            xpos__lt=(player.xpos+2),
-            ypos__gt=(player.ypos-2),
-            ypos__lt=(player.ypos+2),
-            on_pitch=True, down=False).count() - 1
+        n_helpers = session.pitch().n_helpers(player)
         if n_helpers > 0:
             required_result = 2
         else:
@@ -572,47 +474,358 @@ def resolve(match, step_type, data):
         result['requiredResult'] = required_result
         if result['success']:
             player.tackle_zones = True
-            player.remove_effect('Really Stupid')
+            player.remove_effect(skills.REALLY_STUPID)
         else:
             player.tackle_zones = False
-            player.add_effect('Really Stupid')
+            player.add_effect(skills.REALLY_STUPID)
             player.finished_action = True
-        player.save()
         return result
 
-def n_tackle_zones(player):
-    opponents = PlayerInGame.objects.filter(
-        match=player.match)
-    opponents = opponents.exclude(
-        player__team=player.player.team)
-    opponents = opponents.filter(
-        xpos__gt=(player.xpos-2), ypos__gt=(player.ypos-2))
-    opponents = opponents.filter(
-        xpos__lt=(player.xpos+2), ypos__lt=(player.ypos+2))
-    opponents = opponents.filter(
-        tackle_zones=True)
-    opponents = opponents.filter(
-        on_pitch=True)
-    return opponents.count()
+def place_formation(session, side, placements):
+    """Put a side's players on the given squares and the rest in reserve.
+
+    placements is a list of [number, xpos, ypos]. Returns the placements
+    that were used, after checking that they form a legal setup.
+    """
+    match = session.match
+    end_zone = match.end_zone(side)
+    placed = {}
+    squares = set()
+    for num, xpos, ypos in placements:
+        num, xpos, ypos = int(num), int(xpos), int(ypos)
+        player = session.player(side, num)
+        if (player.knocked_out or player.casualty or player.sent_off or
+                num in placed):
+            raise ValueError('Player cannot be placed: ' + str(num))
+        if not on_pitch(xpos, ypos) or abs(xpos - end_zone) > 12:
+            raise ValueError('Square is not in own half: ' +
+                             str((xpos, ypos)))
+        if (xpos, ypos) in squares:
+            raise ValueError('Two players placed on one square: ' +
+                             str((xpos, ypos)))
+        squares.add((xpos, ypos))
+        placed[num] = (xpos, ypos)
+    if len(placed) > 11:
+        raise ValueError('Too many players placed: ' + str(len(placed)))
+    for (player_side, num), player in session.players.items():
+        if player_side != side:
+            continue
+        if num in placed:
+            player.xpos, player.ypos = placed[num]
+            player.on_pitch = True
+        else:
+            player.on_pitch = False
+    return [[num, xpos, ypos] for num, (xpos, ypos) in sorted(placed.items())]
+
+def submit_players(match):
+    """Finish one side's setup and hand over to the other side."""
+    match.n_to_place -= 1
+    if match.n_to_place == 0:
+        match.turn_type = 'placeBall'
+    match.current_side = other_side(match.current_side)
+
+def move_square(match, pitch, player, x1, y1):
+    """Move a player one square along a path, rolling any dice needed."""
+    if (not on_pitch(x1, y1) or pitch.is_occupied(x1, y1) or
+            max(abs(x1 - player.xpos), abs(y1 - player.ypos)) != 1 or
+            player.move_left <= -2):
+        raise ValueError('Cannot move to square: ' + str((x1, y1)))
+    result = {'x1': x1, 'y1': y1, 'goForIt': None, 'dodge': None,
+              'success': True, 'pickUp': False}
+    dodge = (pitch.n_tackle_zones(player) > 0)
+    if player.move_left <= 0:
+        go_for_it = roll_dice(6, 1)
+        go_for_it['success'] = (go_for_it['dice'][0] != 1)
+        result['goForIt'] = go_for_it
+        result['success'] = go_for_it['success']
+    # The player reaches the square even if they are going to fall over
+    player.xpos = x1
+    player.ypos = y1
+    player.move_left -= 1
+    if player.move_left == -2:
+        player.finished_action = True
+    if player.has_ball:
+        match.x_ball = x1
+        match.y_ball = y1
+    pitch.update(player)
+    if result['success'] and dodge:
+        modifier = 1 - pitch.n_tackle_zones(player)
+        result['dodge'] = roll_agility_dice(player, modifier=modifier)
+        result['success'] = result['dodge']['success']
+    if (result['success'] and not player.has_ball and
+            match.x_ball is not None and
+            (int(match.x_ball), int(match.y_ball)) == (x1, y1)):
+        result['pickUp'] = True
+    return result
+
+def preceding_block(session, position):
+    """Return the block, or reroll of a block, that a resolveBlock step
+    at `position` follows, or None."""
+    step = session.previous_step(position, ignore=('selectBlockDice',))
+    if step is None:
+        return None
+    if (step['stepType'] == 'block' or
+            (step['stepType'] == 'reroll' and
+             step.get('rerollStepType') == 'block')):
+        return step
+    return None
+
+def block_chooser(block):
+    """Return the side that chooses which of the block dice counts."""
+    if block['result']['defenceSt'] > block['result']['attackSt']:
+        return other_side(block['side'])
+    return block['side']
+
+def check_block_choice(session, data, attacking_player, defending_player):
+    """Check that a resolveBlock step chooses one of the dice rolled in
+    the block it follows, by the same players, who are still adjacent."""
+    block = preceding_block(session, session.match.next_position - 1)
+    if (block is None or block['side'] != data['side'] or
+            block['num'] != data['num'] or
+            block['targetNum'] != data['targetNum']):
+        raise ValueError('No block by these players to resolve')
+    if data['selectedDice'] not in block['result']['dice']:
+        raise ValueError('Block dice were not rolled: ' +
+                         data['selectedDice'])
+    if (not attacking_player.on_pitch or not defending_player.on_pitch or
+            max(abs(attacking_player.xpos - defending_player.xpos),
+                abs(attacking_player.ypos - defending_player.ypos)) != 1):
+        raise ValueError('Players in the block are not adjacent')
+
+def resolve_block(session, attacking_player, defending_player, dice,
+                  push_path, follow_up):
+    """Carry out the chosen block dice result.
+
+    push_path holds the square the defender is pushed to, followed by the
+    square for each player they are pushed into in turn.
+    """
+    match = session.match
+    pitch = session.pitch()
+    result = {'selectedDice': dice, 'pushes': [], 'followUp': False,
+              'knockDowns': [], 'ball': None, 'turnover': False}
+    x0 = defending_player.xpos
+    y0 = defending_player.ypos
+    if dice in ['pushed', 'defenderStumbles', 'defenderDown']:
+        if not push_path:
+            raise ValueError('No square to push the defender to')
+        # Find everyone who gets pushed, then move them from the back
+        chain = [defending_player]
+        for x1, y1 in push_path[:-1]:
+            next_player = pitch.player_at(int(x1), int(y1))
+            if next_player is None:
+                raise ValueError('Push path continues past an empty square')
+            chain.append(next_player)
+        if len(chain) != len(push_path):
+            raise ValueError('Push path does not match the players pushed')
+        x1, y1 = push_path[-1]
+        if (on_pitch(int(x1), int(y1)) and
+                pitch.player_at(int(x1), int(y1)) is not None):
+            raise ValueError('Push path ends on an occupied square')
+        # Each player in the chain is pushed away by the one before
+        pusher = (attacking_player.xpos, attacking_player.ypos)
+        pushed = (x0, y0)
+        for x1, y1 in push_path:
+            check_push(pitch, pusher, pushed, (int(x1), int(y1)))
+            pusher, pushed = pushed, (int(x1), int(y1))
+        pushes = []
+        for player, (x1, y1) in reversed(list(zip(chain, push_path))):
+            pushes.append(push_player(match, pitch, player, int(x1), int(y1)))
+            if pushes[-1]['ball'] is not None:
+                result['ball'] = pushes[-1]['ball']
+        result['pushes'] = list(reversed(pushes))
+        if follow_up:
+            attacking_player.xpos = x0
+            attacking_player.ypos = y0
+            if attacking_player.has_ball:
+                match.x_ball = x0
+                match.y_ball = y0
+            pitch.update(attacking_player)
+            result['followUp'] = True
+    victims = []
+    if dice == 'attackerDown':
+        victims.append((attacking_player, defending_player))
+    elif dice == 'bothDown':
+        if not defending_player.has_skill(skills.BLOCK):
+            victims.append((defending_player, attacking_player))
+        if not attacking_player.has_skill(skills.BLOCK):
+            victims.append((attacking_player, defending_player))
+    elif dice == 'defenderStumbles':
+        if not defending_player.has_skill(skills.DODGE):
+            victims.append((defending_player, attacking_player))
+    elif dice == 'defenderDown':
+        victims.append((defending_player, attacking_player))
+    for victim, perpetrator in victims:
+        if not victim.on_pitch:
+            # Already pushed into the crowd
+            continue
+        if not perpetrator.has_skill(skills.MIGHTY_BLOW):
+            mighty_blow = False
+        elif perpetrator is defending_player:
+            mighty_blow = 'armour'
+        else:
+            mighty_blow = True
+        had_ball = victim.has_ball
+        knock_down_result = knock_down(victim, mighty_blow)
+        knock_down_result.update({'side': victim.side,
+                                  'num': victim.number})
+        result['knockDowns'].append(knock_down_result)
+        pitch.update(victim)
+        if had_ball:
+            result['ball'] = {'event': 'scatter',
+                              'x': victim.xpos, 'y': victim.ypos}
+        if victim is attacking_player:
+            result['turnover'] = True
+    return result
+
+def push_squares(pusher, pushed):
+    """Return the three squares that a player on `pushed` can be pushed
+    into by a player on `pusher`."""
+    (x0, y0), (x1, y1) = pusher, pushed
+    dx = x1 - x0
+    dy = y1 - y0
+    if max(abs(dx), abs(dy)) != 1:
+        raise ValueError('Cannot push from {} to {}'.format(pusher, pushed))
+    if dx == 0:
+        return [(x1 - 1, y1 + dy), (x1, y1 + dy), (x1 + 1, y1 + dy)]
+    elif dy == 0:
+        return [(x1 + dx, y1 - 1), (x1 + dx, y1), (x1 + dx, y1 + 1)]
+    return [(x1 + dx, y1), (x1 + dx, y1 + dy), (x1, y1 + dy)]
+
+def check_push(pitch, pusher, pushed, square):
+    """Check that a push from `pushed` to `square` is allowed.
+
+    A player must be pushed into an empty square if there is one, then
+    into the crowd if any of the squares is off the pitch, and only into
+    another player if all three are occupied.
+    """
+    squares = push_squares(pusher, pushed)
+    if square not in squares:
+        raise ValueError('Cannot push to square: ' + str(square))
+    empty = [(x, y) for x, y in squares
+             if on_pitch(x, y) and pitch.player_at(x, y) is None]
+    if empty:
+        allowed = empty
+    elif not all(on_pitch(x, y) for x, y in squares):
+        allowed = [(x, y) for x, y in squares if not on_pitch(x, y)]
+    else:
+        allowed = squares
+    if square not in allowed:
+        raise ValueError('Cannot push to square: ' + str(square))
+
+def push_player(match, pitch, player, x1, y1):
+    """Push a player one square, possibly into the crowd."""
+    result = {'side': player.side, 'num': player.number,
+              'x0': player.xpos, 'y0': player.ypos, 'x1': x1, 'y1': y1,
+              'offPitch': not on_pitch(x1, y1), 'injuryRoll': None,
+              'ball': None}
+    if result['offPitch']:
+        player.on_pitch = False
+        injury_roll = roll_injury_dice(player)
+        if injury_roll['result'] == 'knockedOut':
+            player.knocked_out = True
+        elif injury_roll['result'] == 'casualty':
+            player.casualty = True
+        result['injuryRoll'] = injury_roll
+        if player.has_ball:
+            # The crowd throws the ball back in from where they were
+            player.has_ball = False
+            match.x_ball = player.xpos
+            match.y_ball = player.ypos
+            result['ball'] = {'event': 'throwin',
+                              'x': player.xpos, 'y': player.ypos}
+    else:
+        player.xpos = x1
+        player.ypos = y1
+        if player.has_ball:
+            match.x_ball = x1
+            match.y_ball = y1
+        elif (match.x_ball is not None and
+                (int(match.x_ball), int(match.y_ball)) == (x1, y1)):
+            # Pushed onto the loose ball, which bounces away
+            result['ball'] = {'event': 'scatter', 'x': x1, 'y': y1}
+    pitch.update(player)
+    return result
+
+def knock_down(player, mighty_blow=False):
+    """Knock a player over and roll against their armour.
+
+    mighty_blow may be 'armour' or 'injury' to add one to that roll, or
+    True to use it on whichever roll it makes a difference to.
+    """
+    player.down = True
+    player.tackle_zones = False
+    player.has_ball = False
+    # Roll against armour
+    modifier = 1 if mighty_blow == 'armour' else 0
+    armour_roll = roll_armour_dice(player, modifier=modifier)
+    if mighty_blow is True:
+        if armour_roll['success']:
+            mighty_blow = 'injury'
+        elif armour_roll['modifiedResult'] + 1 > player.av:
+            armour_roll['modifiedResult'] += 1
+            armour_roll['success'] = True
+            mighty_blow = 'armour'
+        else:
+            mighty_blow = False
+    if armour_roll['success']:
+        modifier = 1 if mighty_blow == 'injury' else 0
+        injury_roll = roll_injury_dice(player, modifier=modifier)
+        apply_injury(player, injury_roll)
+    else:
+        injury_roll = None
+    return {'armourRoll': armour_roll, 'injuryRoll': injury_roll,
+            'mightyBlow': mighty_blow}
+
+def apply_injury(player, injury_roll):
+    """Update a player according to the result of an injury roll."""
+    if injury_roll['result'] == 'stunned':
+        player.stunned = True
+        player.stunned_this_turn = True
+    elif injury_roll['result'] == 'knockedOut':
+        player.knocked_out = True
+        player.on_pitch = False
+    elif injury_roll['result'] == 'casualty':
+        player.casualty = True
+        player.on_pitch = False
+    elif injury_roll['result'] == 'regenerated':
+        # Back to the reserves box
+        player.on_pitch = False
+    else:
+        raise ValueError('Injury roll returned unexpected result: ' + 
+                         injury_roll['result'])
+
+def block_strength(pitch, player, opponent):
+    """Return a player's strength in a block, including assists."""
+    return player.st + pitch.n_assists(
+        player, opponent, int(opponent.tackle_zones))
+
+def n_block_dice(attack_st, defence_st):
+    """How many block dice are rolled; the stronger player chooses."""
+    if attack_st > (2 * defence_st) or (2 * attack_st) < defence_st:
+        return 3
+    elif attack_st != defence_st:
+        return 2
+    return 1
+
+BLOCK_DICE = {
+    1: "attackerDown",
+    2: "bothDown",
+    3: "pushed",
+    4: "pushed",
+    5: "defenderStumbles",
+    6: "defenderDown"
+}
 
 def roll_block_dice(n_dice):
     result_num = roll_dice(6, n_dice)
-    block_dice_dict = {
-        1: "attackerDown",
-        2: "bothDown",
-        3: "pushed",
-        4: "pushed",
-        5: "defenderStumbles",
-        6: "defenderDown"
-    }
     return {"nDice": n_dice,
-        "dice": [block_dice_dict[num] for num in result_num["dice"]]}
+        "dice": [BLOCK_DICE[num] for num in result_num["dice"]]}
 
 def roll_armour_dice(player, modifier=0):
     dice = roll_dice(6, 2)
     raw_result = sum(dice['dice'])
     modified_result = raw_result + modifier
-    success = (modified_result > player.player.av)
+    success = (modified_result > player.av)
     return {'dice': dice, 'rawResult': raw_result, 
             'modifiedResult': modified_result, 'success': success}
 
@@ -620,8 +833,9 @@ def roll_injury_dice(player, modifier=0):
     dice = roll_dice(6, 2)
     raw_result = sum(dice['dice'])
     modified_result = raw_result + modifier
-    thick_skull = player.has_skill('Thick Skull')
-    regeneration = player.has_skill('Regeneration')
+    thick_skull = player.has_skill(skills.THICK_SKULL)
+    regeneration = player.has_skill(skills.REGENERATION)
+    regeneration_dict = None
     if modified_result <= 7 or (modified_result == 8 and thick_skull):
         result = 'stunned'
     elif modified_result <= 9:
@@ -631,18 +845,19 @@ def roll_injury_dice(player, modifier=0):
         if regeneration:
             regeneration_dice = roll_dice(6, 1)
             regeneration_success = regeneration_dice['dice'][0] >= 4
+            regeneration_dict = {'dice': regeneration_dice,
+                                 'success': regeneration_success}
             if regeneration_success:
                 # Actually, they've regenerated!
                 result = 'regenerated'
     result_dict = {'dice': dice, 'rawResult': raw_result, 
                    'modifiedResult': modified_result, 'result': result}
-    if regeneration:
-        result_dict['regeneration'] = {'dice': regeneration_dice,
-                                       'success': regeneration_success}
+    if regeneration_dict is not None:
+        result_dict['regeneration'] = regeneration_dict
     return result_dict
 
 def roll_agility_dice(player, modifier=0):
-    required_result = 7 - min(player.player.ag, 6)
+    required_result = 7 - min(player.ag, 6)
     dice = roll_dice(6, 1)
     raw_result = sum(dice['dice'])
     modified_result = raw_result + modifier
@@ -656,9 +871,42 @@ def roll_agility_dice(player, modifier=0):
             'modifiedResult': modified_result, 
             'requiredResult': required_result, 'success': success}
 
+# The dice being recorded or replayed in the current thread
+_dice = threading.local()
+
+@contextmanager
+def recorded_dice(rolls=None, stream=None):
+    """Collect every roll made inside the block in the yielded list.
+
+    If `rolls` is given, the dice are taken from it in order rather than
+    rolled, so that a step can be replayed exactly. Otherwise they come
+    from `stream`, a game.dice.DiceStream, if there is one.
+    """
+    _dice.replay = None if rolls is None else iter(rolls)
+    _dice.stream = stream
+    _dice.log = []
+    try:
+        yield _dice.log
+    finally:
+        _dice.replay = None
+        _dice.stream = None
+        _dice.log = None
+
 def roll_dice(n_sides, n_dice):
-    return {"nDice": n_dice,
-        "dice": [random.randint(1, n_sides) for i in range(n_dice)]}
+    replay = getattr(_dice, 'replay', None)
+    stream = getattr(_dice, 'stream', None)
+    if replay is not None:
+        dice = next(replay, None)
+        if dice is None:
+            raise ValueError('No recorded dice left to replay')
+    elif stream is not None:
+        dice = [stream.roll(n_sides) for i in range(n_dice)]
+    else:
+        dice = [random.randint(1, n_sides) for i in range(n_dice)]
+    log = getattr(_dice, 'log', None)
+    if log is not None:
+        log.append(dice)
+    return {"nDice": n_dice, "dice": dice}
 
 def is_double(dice):
     return dice['dice'][0] == dice['dice'][1]
@@ -705,11 +953,6 @@ def other_side(side):
     else:
         raise ValueError('Unrecognised side: ' + side)
         
-def previous_step(match, data):
-    """Return the previous step from the match"""
-    history = Step.objects.filter(match=match).order_by('-history_position')
-    return history[1]
-
 # def current_team(match):
 #     step_set = Step.objects.filter(match=match).order_by('-history_position')
 #     for step in step_set:
@@ -1,3 +1,946 @@
-from django.test import TestCase
+import json
+import random
+from fractions import Fraction
+from itertools import product
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from game import broadcast, odds, skills, snapshots, start_test_game
+from game.define_teams import define_all
+from game.dice import DiceStream
+from game.engine import Engine, MatchState, PlayerState, to_engine
+from game.models import (
+    Formation, Match, PlayerInGame, Snapshot, Step, create_pig,
+    create_player, field_values, save_snapshot)
+from game.pitch import Pitch
+from game.session import MatchSession
+from game.simulate import simulate
+from game.step_types import parse_step
+from game.steps import BLOCK_DICE as BLOCK_FACES
+from game.steps import (
+    block_chooser, check_push, push_squares, recorded_dice, resolve,
+    roll_agility_dice, roll_block_dice)
+
+
+def make_player(side, number, xpos, ypos, **values):
+    """A standing player, in memory only."""
+    defaults = dict(on_pitch=True, down=False, tackle_zones=True, st=3,
+                    ag=3, ma=6, av=8, skill_bits=0, effect_bits=0)
+    defaults.update(values)
+    return PlayerState(side=side, number=number, xpos=xpos, ypos=ypos,
+                       **defaults)
+
+
+def adjacent(player, other):
+    return (abs(player.xpos - other.xpos) <= 1 and
+            abs(player.ypos - other.ypos) <= 1)
+
+def loop_tackle_zones(players, player):
+    """Count tackle zones by checking every player, as before Pitch."""
+    return sum(1 for other in players
+               if other.side != player.side and other.on_pitch and
+               other.tackle_zones and adjacent(player, other))
+
+def loop_assists(players, assisted, target, allowed_zones):
+    return sum(1 for other in players
+               if other.side == assisted.side and other is not assisted and
+               other.on_pitch and not other.down and other.tackle_zones and
+               adjacent(target, other) and
+               loop_tackle_zones(players, other) == allowed_zones)
+
+def loop_helpers(players, player):
+    return sum(1 for other in players
+               if other.side == player.side and other.on_pitch and
+               not other.down and adjacent(player, other)) - 1
+
+
+class PitchTest(SimpleTestCase):
+
+    def random_players(self, rng):
+        squares = rng.sample([(x, y) for x in range(8, 18)
+                              for y in range(8)], 22)
+        players = []
+        for i, (xpos, ypos) in enumerate(squares):
+            down = rng.random() < 0.2
+            players.append(make_player(
+                ('home', 'away')[i % 2], i // 2 + 1, xpos, ypos, down=down,
+                tackle_zones=not down and rng.random() < 0.9,
+                on_pitch=rng.random() < 0.95))
+        return players
+
+    def check_counts(self, pitch, players):
+        for player in players:
+            if not player.on_pitch:
+                continue
+            self.assertEqual(pitch.n_tackle_zones(player),
+                             loop_tackle_zones(players, player))
+            self.assertEqual(pitch.n_helpers(player),
+                             loop_helpers(players, player))
+            for target in players:
+                if target.side == player.side or not target.on_pitch:
+                    continue
+                for allowed_zones in (0, 1):
+                    self.assertEqual(
+                        pitch.n_assists(player, target, allowed_zones),
+                        loop_assists(players, player, target, allowed_zones))
+
+    def test_matches_loops(self):
+        rng = random.Random(3)
+        for trial in range(20):
+            players = self.random_players(rng)
+            self.check_counts(Pitch(players), players)
+
+    def test_update(self):
+        rng = random.Random(4)
+        players = self.random_players(rng)
+        pitch = Pitch(players)
+        for player in players[:5]:
+            if pitch.is_occupied(player.xpos, 9):
+                continue
+            player.ypos = 9
+            player.down = not player.down
+            pitch.update(player)
+        self.check_counts(pitch, players)
+
+
+class PushTest(SimpleTestCase):
+
+    def test_push_squares(self):
+        self.assertEqual(push_squares((5, 5), (6, 5)),
+                         [(7, 4), (7, 5), (7, 6)])
+        self.assertEqual(push_squares((5, 5), (5, 4)),
+                         [(4, 3), (5, 3), (6, 3)])
+        self.assertEqual(push_squares((5, 5), (6, 6)),
+                         [(7, 6), (7, 7), (6, 7)])
+
+    def test_not_adjacent(self):
+        with self.assertRaises(ValueError):
+            push_squares((5, 5), (7, 5))
+
+    def test_must_push_away(self):
+        pitch = Pitch([])
+        check_push(pitch, (5, 5), (6, 5), (7, 6))
+        for square in [(5, 5), (6, 6), (8, 5), (10, 10)]:
+            with self.assertRaises(ValueError):
+                check_push(pitch, (5, 5), (6, 5), square)
+
+    def test_empty_square_first(self):
+        pitch = Pitch([make_player('home', 1, 7, 5)])
+        with self.assertRaises(ValueError):
+            check_push(pitch, (5, 5), (6, 5), (7, 5))
+        check_push(pitch, (5, 5), (6, 5), (7, 4))
+
+    def test_into_player_only_when_all_occupied(self):
+        pitch = Pitch([make_player('home', number, 7, ypos)
+                       for number, ypos in enumerate((4, 5, 6))])
+        check_push(pitch, (5, 5), (6, 5), (7, 5))
+
+    def test_crowd(self):
+        pitch = Pitch([make_player('home', 1, 0, 0)])
+        # The only square on the pitch is taken, so into the crowd
+        check_push(pitch, (2, 1), (1, 0), (1, -1))
+        with self.assertRaises(ValueError):
+            check_push(pitch, (2, 1), (1, 0), (0, 0))
+
+
+class ListDice(object):
+    """Dice that come up as listed, for an Engine."""
+
+    def __init__(self, rolls):
+        self.rolls = list(rolls)
+
+    def roll(self, n_sides):
+        return self.rolls.pop(0)
+
+
+class ResolveBlockTest(SimpleTestCase):
+    """A home player on (5, 5) blocks an away player on (6, 5)."""
+
+    def block(self, face, attacker=None, defender=None, **data):
+        """Roll `face` on the block die and resolve the block with `data`."""
+        self.roll_block(face, attacker, defender)
+        return self.resolve_block(face, **data)
+
+    def roll_block(self, face, attacker=None, defender=None):
+        self.attacker = make_player('home', 1, 5, 5, **(attacker or {}))
+        self.defender = make_player('away', 1, 6, 5, **(defender or {}))
+        # Team-mates well away from the block
+        players = [self.attacker, self.defender,
+                   make_player('home', 2, 10, 10),
+                   make_player('away', 2, 12, 10)]
+        match = MatchState(next_position=0, current_side='home',
+                           turn_type='normal', turn_number=1,
+                           home_first_direction='right')
+        self.engine = Engine(match, players)
+        # A single die for the block, then double ones for any armour
+        self.engine.dice = ListDice([face] + [1] * 8)
+        self.engine.resolve('block', {'side': 'home', 'num': 1,
+                                      'targetNum': 1, 'action': 'block'})
+
+    def resolve_block(self, face, **data):
+        resolve_data = {'side': 'home', 'num': 1, 'targetNum': 1,
+                        'selectedDice': BLOCK_FACES[face]}
+        resolve_data.update(data)
+        return self.engine.resolve('resolveBlock', resolve_data)
+
+    def test_push_without_follow_up(self):
+        result = self.block(3, pushPath='[[7, 4]]', followUp='false')
+        self.assertEqual((self.defender.xpos, self.defender.ypos), (7, 4))
+        self.assertEqual((self.attacker.xpos, self.attacker.ypos), (5, 5))
+        self.assertFalse(self.defender.down)
+        self.assertEqual(result['knockDowns'], [])
+
+    def test_defender_down_and_follow_up(self):
+        result = self.block(6, pushPath='[[7, 5]]', followUp='true')
+        self.assertEqual((self.defender.xpos, self.defender.ypos), (7, 5))
+        self.assertEqual((self.attacker.xpos, self.attacker.ypos), (6, 5))
+        self.assertTrue(self.defender.down)
+        self.assertEqual(len(result['knockDowns']), 1)
+        self.assertFalse(result['turnover'])
+
+    def test_dodge_on_defender_stumbles(self):
+        result = self.block(5, defender={'skill_bits': skills.DODGE},
+                            pushPath='[[7, 5]]')
+        self.assertEqual((self.defender.xpos, self.defender.ypos), (7, 5))
+        self.assertFalse(self.defender.down)
+        self.assertEqual(result['knockDowns'], [])
+        self.block(5, pushPath='[[7, 5]]')
+        self.assertTrue(self.defender.down)
+
+    def test_both_down(self):
+        result = self.block(2)
+        self.assertTrue(self.attacker.down)
+        self.assertTrue(self.defender.down)
+        self.assertTrue(result['turnover'])
+        result = self.block(2, attacker={'skill_bits': skills.BLOCK})
+        self.assertFalse(self.attacker.down)
+        self.assertTrue(self.defender.down)
+        self.assertFalse(result['turnover'])
+
+    def test_attacker_down(self):
+        result = self.block(1)
+        self.assertTrue(self.attacker.down)
+        self.assertFalse(self.defender.down)
+        self.assertTrue(result['turnover'])
+
+    def test_dice_not_rolled(self):
+        with self.assertRaises(ValueError):
+            self.block(1, selectedDice='defenderDown', pushPath='[[7, 5]]')
+        with self.assertRaises(ValueError):
+            self.block(1, selectedDice='foo')
+
+    def test_other_players(self):
+        with self.assertRaises(ValueError):
+            self.block(1, targetNum=2)
+        with self.assertRaises(ValueError):
+            self.block(1, num=2)
+
+    def test_needs_a_block(self):
+        self.block(1)
+        with self.assertRaises(ValueError):
+            self.resolve_block(1)
+
+    def test_not_adjacent(self):
+        self.roll_block(6)
+        self.defender.xpos = 7
+        with self.assertRaises(ValueError):
+            self.resolve_block(6, pushPath='[[8, 5]]')
+
+    def test_chooser(self):
+        block = {'side': 'home', 'result': {'attackSt': 3, 'defenceSt': 4}}
+        self.assertEqual(block_chooser(block), 'away')
+        block['result']['attackSt'] = 4
+        self.assertEqual(block_chooser(block), 'home')
+
+class ParseStepTest(SimpleTestCase):
+
+    def test_converts_fields(self):
+        parsed = parse_step('movePath', {
+            'side': 'home', 'num': '3', 'action': 'move',
+            'path': '[[5, 6], [6, 6]]', 'goForIt': 'false', 'extra': 'kept'})
+        self.assertEqual(parsed, {
+            'side': 'home', 'num': 3, 'action': 'move',
+            'path': [[5, 6], [6, 6]], 'goForIt': False, 'extra': 'kept'})
+
+    def test_missing_field(self):
+        with self.assertRaises(ValueError):
+            parse_step('pickUp', {'side': 'home'})
+
+    def test_empty_required_field(self):
+        for value in ('', None):
+            with self.assertRaises(ValueError):
+                parse_step('pickUp', {'side': 'home', 'num': value})
+        with self.assertRaises(ValueError):
+            parse_step('catch', {'side': 'home', 'num': 1, 'accurate': ''})
+
+    def test_bad_values(self):
+        with self.assertRaises(ValueError):
+            parse_step('pickUp', {'side': 'left', 'num': 1})
+        with self.assertRaises(ValueError):
+            parse_step('pickUp', {'side': 'home', 'num': 'one'})
+        with self.assertRaises(ValueError):
+            parse_step('catch', {'side': 'home', 'num': 1, 'accurate': 'yes'})
+        with self.assertRaises(ValueError):
+            parse_step('kickOffTheRoof', {})
+
+    def test_empty_optional_field(self):
+        for value in ('', None):
+            self.assertEqual(parse_step('endKickoff', {'touchback': value}),
+                             {'touchback': None})
+        self.assertEqual(parse_step('endKickoff', {'touchback': 'false'}),
+                         {'touchback': False})
+        self.assertEqual(parse_step('endKickoff', {}), {})
+
+    def test_reroll(self):
+        parsed = parse_step('reroll', {
+            'rerollType': 'team', 'rerollStepType': 'pickUp',
+            'side': 'away', 'num': '2'})
+        self.assertEqual(parsed['num'], 2)
+        with self.assertRaises(ValueError):
+            parse_step('reroll', {'rerollType': 'team',
+                                  'rerollStepType': 'reroll'})
+
+
+class SkillBitsTest(SimpleTestCase):
+
+    def test_round_trip(self):
+        bits = skills.skill_bits('Block,Dodge')
+        self.assertEqual(bits, skills.BLOCK | skills.DODGE)
+        self.assertEqual(skills.skill_names(bits), ['Dodge', 'Block'])
+        self.assertEqual(skills.skill_bits(''), 0)
+
+    def test_unrecognised_skill(self):
+        with self.assertLogs('game.skills', 'WARNING'):
+            self.assertEqual(skills.skill_bits('Block,Juggling'),
+                             skills.BLOCK)
+        self.assertFalse(skills.all_recognised('Block,Juggling'))
+        self.assertTrue(skills.all_recognised('Block,Dodge'))
+
+
+class DiceStreamTest(SimpleTestCase):
+
+    def rolls(self, seed, position):
+        stream = DiceStream(seed, position)
+        return [stream.roll(6) for i in range(40)]
+
+    def test_repeatable(self):
+        rolls = self.rolls(1234, 7)
+        self.assertEqual(rolls, self.rolls(1234, 7))
+        self.assertTrue(all(1 <= roll <= 6 for roll in rolls))
+
+    def test_depends_on_seed_and_position(self):
+        self.assertNotEqual(self.rolls(1234, 7), self.rolls(1234, 8))
+        self.assertNotEqual(self.rolls(1234, 7), self.rolls(1235, 7))
+
+
+def passing_faces(ag, modifier=0):
+    """The faces of a die that pass an agility roll in the rules code."""
+    player = make_player('home', 1, 5, 5, ag=ag)
+    faces = set()
+    for face in range(1, 7):
+        with recorded_dice([[face]]):
+            if roll_agility_dice(player, modifier)['success']:
+                faces.add(face)
+    return faces
+
+def brute_force_chain(rolls, team_reroll=False, player_skills=0):
+    """The chance of passing every roll, found by trying every die.
+
+    Each roll is a (faces, skill) pair. A failure is rerolled with the
+    skill if possible and otherwise with the team reroll.
+    """
+    loner = player_skills & skills.LONER
+    # A die for each roll, one for its reroll and one for Loner
+    per_roll = 3 if loner else 2
+    n_passes = 0
+    n_outcomes = 0
+    for dice in product(range(1, 7), repeat=per_roll * len(rolls)):
+        n_outcomes += 1
+        team, dodge_used = team_reroll, False
+        for i, (faces, skill) in enumerate(rolls):
+            roll_dice = dice[per_roll * i:per_roll * (i + 1)]
+            if roll_dice[0] in faces:
+                continue
+            if (player_skills & skill and
+                    not (skill == skills.DODGE and dodge_used)):
+                dodge_used = dodge_used or skill == skills.DODGE
+            elif team:
+                team = False
+            else:
+                break
+            if loner and roll_dice[2] < 4:
+                break
+            if roll_dice[1] not in faces:
+                break
+        else:
+            n_passes += 1
+    return Fraction(n_passes, n_outcomes)
+
+
+class OddsTest(SimpleTestCase):
+
+    def test_agility(self):
+        for ag in range(1, 7):
+            for modifier in range(-3, 2):
+                self.assertEqual(
+                    odds.agility(ag, modifier),
+                    Fraction(len(passing_faces(ag, modifier)), 6))
+
+    def test_chain(self):
+        dodge = (passing_faces(3), skills.DODGE)
+        go_for_it = (set(range(2, 7)), 0)
+        pick_up = (passing_faces(3, 1), skills.SURE_HANDS)
+        cases = [
+            ((dodge, go_for_it, pick_up), False, 0),
+            ((dodge, go_for_it, pick_up), True, 0),
+            ((dodge, go_for_it, pick_up), True,
+             skills.DODGE | skills.SURE_HANDS),
+            ((dodge, dodge, go_for_it), True, skills.DODGE),
+            ((dodge, go_for_it), True, skills.LONER | skills.DODGE),
+        ]
+        for rolls, team_reroll, player_skills in cases:
+            chances = tuple((Fraction(len(faces), 6), skill)
+                            for faces, skill in rolls)
+            self.assertEqual(
+                odds.chain(chances, team_reroll, player_skills),
+                brute_force_chain(rolls, team_reroll, player_skills))
+
+    def test_block(self):
+        for attacker_skills, defender_skills in [
+                (0, 0), (skills.BLOCK, 0), (skills.BLOCK, skills.BLOCK),
+                (0, skills.DODGE)]:
+
+            def good(face):
+                return (face == 'defenderDown' or
+                        (face == 'defenderStumbles' and
+                         not defender_skills & skills.DODGE) or
+                        (face == 'bothDown' and
+                         attacker_skills & skills.BLOCK and
+                         not defender_skills & skills.BLOCK))
+
+            for n_dice in range(1, 4):
+                for attacker_chooses in (True, False):
+                    n_good = 0
+                    for dice in product(range(1, 7), repeat=n_dice):
+                        with recorded_dice([list(dice)]):
+                            faces = roll_block_dice(n_dice)['dice']
+                        if attacker_chooses:
+                            n_good += any(good(face) for face in faces)
+                        else:
+                            n_good += all(good(face) for face in faces)
+                    self.assertEqual(
+                        odds.block(n_dice, attacker_chooses,
+                                   attacker_skills, defender_skills),
+                        Fraction(n_good, 6 ** n_dice))
+
+
+class MatchTestCase(TestCase):
+    """A match after the kickoff, with the away side to play."""
+
+    def setUp(self):
+        cache.clear()
+        define_all()
+        for username in ('alice', 'bob'):
+            User.objects.create_user(username, 'x@example.com', 'pw')
+        self.match = start_test_game.start_after_kickoff()
+        self.client.login(username='bob', password='pw')
+
+    def number_at(self, xpos, ypos):
+        return PlayerInGame.objects.get(
+            match=self.match, xpos=xpos, ypos=ypos).number
+
+    def step(self, step_type, position, **data):
+        data.update(stepType=step_type, matchId=self.match.id,
+                    historyPosition=position)
+        return data
+
+    def post(self, step_type, position, **data):
+        return self.post_data(self.step(step_type, position, **data))
+
+    def post_data(self, data):
+        response = self.client.post(
+            '/game/post_step', urlencode(data),
+            content_type='application/x-www-form-urlencoded')
+        return json.loads(response.content.decode())
+
+    def play_turn(self):
+        """Move a player and make a block, which rolls dice."""
+        self.post('move', 0, side='away', num=self.number_at(13, 3),
+                  action='move', x0=13, y0=3, x1=14, y1=3, dodge='false')
+        result = self.post('block', 1, side='away', num=self.number_at(13, 4),
+                           targetNum=self.number_at(12, 5), action='block')
+        self.assertTrue(result['dice'])
+        self.post('endTurn', 2, side='away')
+
+
+class AuditTest(MatchTestCase):
+
+    def unseed(self):
+        # As for a match started before the dice were seeded
+        self.match.dice_seed = None
+        self.match.save()
+        save_snapshot(self.match, self.match.playeringame_set.all())
+
+    def test_replays_match(self):
+        self.play_turn()
+        self.assertEqual(snapshots.audit(self.match.id), [])
+
+    def test_finds_changed_result(self):
+        self.play_turn()
+        step = Step.objects.get(match=self.match, history_position=1)
+        result = json.loads(step.result)
+        result['dice'] = []
+        step.result = json.dumps(result)
+        step.save()
+        self.assertEqual(snapshots.audit(self.match.id), [1])
+
+    def test_recorded_rolls(self):
+        self.unseed()
+        self.play_turn()
+        self.assertTrue(Step.objects.get(
+            match=self.match, history_position=1).rolls)
+        self.assertEqual(snapshots.audit(self.match.id), [])
+
+    def test_no_rolls_or_seed(self):
+        self.unseed()
+        self.play_turn()
+        Step.objects.filter(match=self.match).update(rolls='')
+        with self.assertRaises(ValueError):
+            snapshots.audit(self.match.id)
+
+
+class RebuildTest(MatchTestCase):
+
+    def saved_state(self):
+        match = Match.objects.get(id=self.match.id)
+        players = PlayerInGame.objects.filter(match=self.match)
+        return (field_values(match),
+                {player.pk: field_values(player) for player in players})
+
+    def session_state(self, session):
+        return (field_values(session.match),
+                {player.pk: field_values(player)
+                 for player in session.players.values()})
+
+    def test_rebuilds_current_position(self):
+        self.play_turn()
+        # Replay from the kickoff rather than the end of turn snapshot
+        Snapshot.objects.filter(
+            match=self.match, history_position__gt=0).delete()
+        state = self.saved_state()
+        session = snapshots.rebuild(self.match.id, 3)
+        self.assertEqual(self.session_state(session), state)
+        # Nothing is written back
+        self.assertEqual(self.saved_state(), state)
+
+    def test_rebuilds_earlier_position(self):
+        number = self.number_at(13, 3)
+        self.play_turn()
+        session = snapshots.rebuild(self.match.id, 1)
+        player = session.player('away', number)
+        self.assertEqual((player.xpos, player.ypos), (14, 3))
+        self.assertEqual(session.match.next_position, 1)
+
+    def test_no_such_position(self):
+        with self.assertRaises(ValueError):
+            snapshots.rebuild(self.match.id, 1)
+        Snapshot.objects.filter(match=self.match).delete()
+        with self.assertRaises(ValueError):
+            snapshots.rebuild(self.match.id, 0)
+
+
+class MatchSessionTest(MatchTestCase):
+
+    def flush_updates(self, session):
+        """Flush the session and return the UPDATE statements it made."""
+        with CaptureQueriesContext(connection) as queries:
+            session.flush()
+        return [query['sql'] for query in queries.captured_queries
+                if 'UPDATE' in query['sql']]
+
+    def test_flush_writes_changed_fields(self):
+        session = MatchSession(self.match.id)
+        player = session.player('away', self.number_at(13, 3))
+        self.assertEqual(session.changed_fields(player), [])
+        player.xpos = 14
+        session.match.turn_number = 2
+        self.assertEqual(session.changed_fields(player), ['xpos'])
+        self.assertEqual(len(self.flush_updates(session)), 2)
+        self.assertEqual(PlayerInGame.objects.get(id=player.id).xpos, 14)
+        self.assertEqual(Match.objects.get(id=self.match.id).turn_number, 2)
+        # Nothing has changed since
+        self.assertEqual(session.changed_fields(player), [])
+        self.assertEqual(self.flush_updates(session), [])
+
+    def test_one_statement_for_a_team(self):
+        session = MatchSession(self.match.id)
+        for player in session.players.values():
+            if player.side == 'away':
+                player.finished_action = True
+                player.move_left = 0
+        self.assertEqual(len(self.flush_updates(session)), 1)
+        self.assertEqual(PlayerInGame.objects.filter(
+            match=self.match, finished_action=True, move_left=0).count(),
+            PlayerInGame.objects.filter(
+                match=self.match, side='away').count())
+
+    def test_leaves_other_fields_alone(self):
+        session = MatchSession(self.match.id)
+        player = session.player('away', self.number_at(13, 3))
+        # Changed elsewhere after the session was loaded
+        PlayerInGame.objects.filter(id=player.id).update(ma=9)
+        player.xpos = 14
+        session.flush()
+        player = PlayerInGame.objects.get(id=player.id)
+        self.assertEqual((player.xpos, player.ma), (14, 9))
+
+    def test_formation_saved_on_flush(self):
+        session = MatchSession(self.match.id)
+        placements = [[player.number, player.xpos, player.ypos]
+                      for player in session.players.values()
+                      if player.side == 'home' and player.on_pitch]
+        session.save_formation('home', 'wall', placements)
+        self.assertEqual(session.formation_placements('home', 'wall'),
+                         placements)
+        self.assertFalse(Formation.objects.exists())
+        session.flush()
+        self.assertEqual(
+            MatchSession(self.match.id).formation_placements('home', 'wall'),
+            placements)
+
+
+class FormationTest(MatchTestCase):
+    """The home side setting up for a kickoff."""
+
+    def setUp(self):
+        super().setUp()
+        self.match.turn_type = 'placePlayers'
+        self.match.current_side = 'home'
+        self.match.n_to_place = 2
+        self.match.save()
+        self.placements = sorted(
+            [player.number, player.xpos, player.ypos]
+            for player in PlayerInGame.objects.filter(
+                match=self.match, side='home'))
+
+    def submit(self, session=None, **data):
+        if session is None:
+            session = MatchSession(self.match.id)
+        data.setdefault('side', 'home')
+        result = resolve(session, 'submitFormation', data)
+        return session, result
+
+    def test_places_side(self):
+        self.placements[0][1:] = [3, 3]
+        session, result = self.submit(formation=self.placements)
+        self.assertEqual(result['placements'], self.placements)
+        self.assertEqual((session.player('home', 1).xpos,
+                          session.player('home', 1).ypos), (3, 3))
+        self.assertEqual(session.match.current_side, 'away')
+        self.assertEqual(session.match.n_to_place, 1)
+
+    def test_own_half(self):
+        self.placements[0][1] = 13
+        with self.assertRaisesRegex(ValueError, 'own half'):
+            self.submit(formation=self.placements)
+
+    def test_at_most_eleven(self):
+        player = create_player(self.match.home_team, 'Lineman',
+                               'Human player 12', 12)
+        player.save()
+        create_pig(player, match=self.match, side='home', xpos=0, ypos=0,
+                   on_pitch=False).save()
+        self.placements.append([12, 1, 1])
+        with self.assertRaisesRegex(ValueError, 'Too many'):
+            self.submit(formation=self.placements)
+
+    def test_one_player_per_square(self):
+        self.placements[1][1:] = self.placements[0][1:]
+        with self.assertRaisesRegex(ValueError, 'one square'):
+            self.submit(formation=self.placements)
+
+    def test_unfit_player(self):
+        PlayerInGame.objects.filter(
+            match=self.match, side='home', number=1).update(knocked_out=True)
+        with self.assertRaisesRegex(ValueError, 'cannot be placed'):
+            self.submit(formation=self.placements)
+        with self.assertRaisesRegex(ValueError, 'cannot be placed'):
+            self.submit(formation=self.placements[1:] + self.placements[1:2])
+
+    def test_reuses_saved_formation(self):
+        with self.assertRaisesRegex(ValueError, 'No such formation'):
+            self.submit(formationName='wall')
+        self.placements[0][1:] = [3, 3]
+        session, result = self.submit(formation=self.placements,
+                                      saveAs='wall')
+        session.flush()
+        session = MatchSession(self.match.id)
+        session.match.current_side = 'home'
+        session.player('home', 1).xpos = 5
+        session, result = self.submit(session, formationName='wall')
+        self.assertEqual(result['placements'], self.placements)
+        self.assertEqual(session.player('home', 1).xpos, 3)
+
+    def test_only_while_placing(self):
+        with self.assertRaisesRegex(ValueError, 'Not the side'):
+            self.submit(side='away', formation=[])
+        self.match.turn_type = 'normal'
+        self.match.save()
+        with self.assertRaisesRegex(ValueError, 'not being placed'):
+            self.submit(formation=self.placements)
+
+    def test_refused_step(self):
+        self.client.login(username='alice', password='pw')
+        result = self.post('submitFormation', 0, side='away',
+                           formation=json.dumps(self.placements))
+        self.assertEqual(result['status'], 'invalid')
+        self.assertEqual(
+            Match.objects.get(id=self.match.id).current_side, 'home')
+
+class EngineTest(MatchTestCase):
+    """The same steps played through the server and through an Engine."""
+
+    def turn(self):
+        return [
+            ('move', {'side': 'away', 'num': self.number_at(13, 3),
+                      'action': 'move', 'x0': 13, 'y0': 3, 'x1': 14,
+                      'y1': 3, 'dodge': 'false'}),
+            ('movePath', {'side': 'away', 'num': self.number_at(15, 5),
+                          'action': 'move', 'path': '[[16, 5], [17, 5]]'}),
+            ('block', {'side': 'away', 'num': self.number_at(13, 4),
+                       'targetNum': self.number_at(12, 5),
+                       'action': 'block'}),
+            ('endTurn', {'side': 'away'}),
+        ]
+
+    def test_same_as_server(self):
+        engine = to_engine(MatchSession(self.match.id))
+        for position, (step_type, data) in enumerate(self.turn()):
+            result = engine.resolve(step_type, dict(data))
+            posted = self.post(step_type, position, **data)
+            self.assertEqual(posted['status'], 0)
+            step = Step.objects.get(match=self.match,
+                                    history_position=position)
+            self.assertEqual(json.loads(json.dumps(result)),
+                             step.as_dict()['result'])
+        session = MatchSession(self.match.id)
+        for name in MatchState.__slots__:
+            if name != 'id':
+                self.assertEqual(getattr(engine.match, name),
+                                 getattr(session.match, name), name)
+        for key, player in session.players.items():
+            for name in PlayerState.__slots__:
+                if name != 'id':
+                    self.assertEqual(getattr(engine.players[key], name),
+                                     getattr(player, name), (key, name))
+
+    def test_simulate_repeatable(self):
+        engine = to_engine(MatchSession(self.match.id))
+        first = simulate(engine, n_rollouts=20, seed=5)
+        self.assertEqual(simulate(engine, n_rollouts=20, seed=5), first)
+        self.assertEqual(first['rollouts'], 20)
+
+class FeedTest(MatchTestCase):
+
+    def test_bad_position(self):
+        for url in ('/game/{}/history', '/game/{}/steps'):
+            url = url.format(self.match.id)
+            for value in ('x', '', '-1', '1.5'):
+                response = self.client.get(url, {'since': value})
+                self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            '/game/{}/history'.format(self.match.id), {'until': 'end'})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            '/game/{}/steps'.format(self.match.id), {'since': '0'})
+        self.assertEqual(json.loads(response.content.decode()),
+                         {'steps': [], 'next': 0})
+
+class PathRollsTest(MatchTestCase):
+
+    def path_rolls(self, path):
+        session = MatchSession(self.match.id)
+        player = session.player('away', self.number_at(13, 3))
+        return odds.path_rolls(session, player, path)
+
+    def test_free_path(self):
+        self.assertEqual(self.path_rolls([(14, 3), (15, 3)]), ())
+        # Back through the square the player started on
+        self.assertEqual(self.path_rolls([(14, 3), (13, 3)]), ())
+
+    def test_squares_move_square_refuses(self):
+        for path in [[(13, 4)], [(15, 3)], [(14, 3), (14, 3)],
+                     [(14, 3), (15, 3), (16, 3), (17, 3), (18, 3), (19, 3),
+                      (20, 3), (21, 3)]]:
+            with self.assertRaises(ValueError):
+                self.path_rolls(path)
+
+    def move_path(self, path, dice, marked=True, move_left=None):
+        """Move an away player from (3, 13) along `path` with the given
+        dice, next to a home player on (2, 13) if `marked`."""
+        session = MatchSession(self.match.id)
+        player = session.player('away', self.number_at(13, 3))
+        player.xpos, player.ypos = 3, 13
+        if move_left is not None:
+            player.move_left = move_left
+        marker = session.player('home', self.number_at(11, 12))
+        marker.xpos, marker.ypos = 2, 13
+        marker.on_pitch = marked
+        with recorded_dice(dice) as rolls:
+            result = resolve(session, 'movePath', {
+                'side': 'away', 'num': player.number, 'action': 'move',
+                'path': path})
+        self.assertEqual(rolls, dice)
+        return result, player
+
+    def test_dodge(self):
+        result, player = self.move_path([(4, 13), (5, 13)], [[6]])
+        self.assertTrue(result['success'])
+        self.assertTrue(result['squares'][0]['dodge']['success'])
+        self.assertIsNone(result['squares'][1]['dodge'])
+        self.assertEqual((player.xpos, player.ypos), (5, 13))
+
+    def test_stops_at_failed_dodge(self):
+        result, player = self.move_path([(4, 13), (5, 13)], [[1]])
+        self.assertFalse(result['success'])
+        self.assertEqual(len(result['squares']), 1)
+        self.assertEqual((player.xpos, player.ypos), (4, 13))
+
+    def test_go_for_it(self):
+        result, player = self.move_path(
+            [(4, 13), (5, 13), (6, 13)], [[2], [1]], marked=False,
+            move_left=1)
+        squares = result['squares']
+        self.assertIsNone(squares[0]['goForIt'])
+        self.assertTrue(squares[1]['goForIt']['success'])
+        self.assertFalse(squares[2]['goForIt']['success'])
+        self.assertFalse(result['success'])
+        self.assertTrue(player.finished_action)
+
+    def test_stops_on_ball(self):
+        self.match.x_ball, self.match.y_ball = 4, 13
+        self.match.save()
+        result, player = self.move_path(
+            [(4, 13), (5, 13)], [], marked=False)
+        self.assertEqual(len(result['squares']), 1)
+        self.assertTrue(result['squares'][0]['pickUp'])
+        self.assertEqual((player.xpos, player.ypos), (4, 13))
+
+
+class PostStepTest(MatchTestCase):
+
+    def moves(self, number, path):
+        """The steps that move a player along `path`, one square each."""
+        return [self.step('move', position, side='away', num=number,
+                          action='move', x0=x0, y0=y0, x1=x1, y1=y1,
+                          dodge='false')
+                for position, ((x0, y0), (x1, y1)) in enumerate(
+                    zip(path, path[1:]))]
+
+    def test_batch(self):
+        number = self.number_at(13, 3)
+        steps = self.moves(number, [(13, 3), (14, 3), (15, 3), (16, 3)])
+        result = self.post_data({'steps': json.dumps(steps)})
+        self.assertEqual(result['status'], 0)
+        self.assertEqual([step_result['status']
+                          for step_result in result['results']], [0, 0, 0])
+        self.assertEqual(self.number_at(16, 3), number)
+        self.assertEqual(Step.objects.filter(match=self.match).count(), 3)
+        self.assertEqual(
+            Match.objects.get(id=self.match.id).next_position, 3)
+
+    def test_batch_stops_at_invalid_step(self):
+        number = self.number_at(13, 3)
+        steps = self.moves(number, [(13, 3), (14, 3), (15, 3), (16, 3)])
+        steps[1]['x1'] = 'east'
+        result = self.post_data({'steps': json.dumps(steps)})
+        self.assertEqual([step_result['status']
+                          for step_result in result['results']],
+                         [0, 'invalid', 'skipped'])
+        self.assertEqual(self.number_at(14, 3), number)
+        self.assertEqual(
+            Match.objects.get(id=self.match.id).next_position, 1)
+
+    def test_batch_resent_once(self):
+        number = self.number_at(13, 3)
+        steps = self.moves(number, [(13, 3), (14, 3), (15, 3), (16, 3)])
+        result = self.post_data({'steps': json.dumps(steps[1:])})
+        self.assertEqual(result['results'],
+                         [{'status': 'resend', 'start': 0},
+                          {'status': 'skipped'}])
+        self.assertFalse(Step.objects.filter(match=self.match).exists())
+
+    def test_bad_batch(self):
+        result = self.post_data({'steps': '[]'})
+        self.assertEqual(result['status'], 'invalid')
+        steps = self.moves(self.number_at(13, 3), [(13, 3), (14, 3), (15, 3)])
+        steps[1]['matchId'] = self.match.id + 1
+        result = self.post_data({'steps': json.dumps(steps)})
+        self.assertEqual(result['status'], 'invalid')
+        self.assertFalse(Step.objects.filter(match=self.match).exists())
+
+    def test_resend(self):
+        number = self.number_at(13, 3)
+        steps = self.moves(number, [(13, 3), (14, 3), (15, 3)])
+        result = self.post_data(steps[1])
+        self.assertEqual(result, {'status': 'resend', 'start': 0})
+        self.assertFalse(Step.objects.filter(match=self.match).exists())
+        self.assertEqual(self.number_at(13, 3), number)
+
+    def test_duplicate(self):
+        number = self.number_at(13, 3)
+        steps = self.moves(number, [(13, 3), (14, 3), (15, 3)])
+        self.assertEqual(self.post_data(steps[0])['status'], 0)
+        self.assertEqual(self.post_data(steps[0]),
+                         {'status': 'duplicate'})
+        # A resent batch only applies the steps that are new
+        result = self.post_data({'steps': json.dumps(steps)})
+        self.assertEqual([step_result['status']
+                          for step_result in result['results']],
+                         ['duplicate', 0])
+        self.assertEqual(self.number_at(15, 3), number)
+        # Moved two squares, not three
+        player = PlayerInGame.objects.get(match=self.match, xpos=15, ypos=3)
+        self.assertEqual(player.move_left, player.ma - 2)
+        self.assertEqual(Step.objects.filter(match=self.match).count(), 2)
+        self.assertEqual(
+            Match.objects.get(id=self.match.id).next_position, 2)
+
+    def test_illegal_path(self):
+        number = self.number_at(13, 3)
+        result = self.post('movePath', 0, side='away', num=number,
+                           action='move', path='[[14, 3], [13, 4]]')
+        self.assertEqual(result['status'], 'invalid')
+        self.assertIn('Cannot move to square', result['message'])
+        self.assertFalse(Step.objects.filter(match=self.match).exists())
+        self.assertEqual(self.number_at(13, 3), number)
+        self.assertEqual(
+            Match.objects.get(id=self.match.id).next_position, 0)
+        # The same position can then be played
+        result = self.post('movePath', 0, side='away', num=number,
+                           action='move', path='[[14, 3], [15, 3]]')
+        self.assertEqual(result['status'], 0)
+        self.assertEqual(self.number_at(15, 3), number)
+
+
+class BroadcastTest(MatchTestCase):
+
+    def test_delay_outlasts_cache(self):
+        self.post('move', 0, side='away', num=self.number_at(13, 3),
+                  action='move', x0=13, y0=3, x1=14, y1=3, dodge='false')
+        self.assertEqual(len(broadcast.payloads(self.match.id, 0)), 1)
+        cache.clear()
+        # A step read back from the database is still too new to show
+        self.assertEqual(broadcast.payloads(self.match.id, 0, 60), [])
+        self.assertEqual(broadcast.delayed_position(self.match.id, 60), 0)
+        self.assertEqual(len(broadcast.payloads(self.match.id, 0)), 1)
+        self.assertEqual(broadcast.delayed_position(self.match.id, 0), 1)
+        # It is shown once it is old enough
+        Step.objects.filter(match=self.match).update(published=0)
+        cache.clear()
+        self.assertEqual(broadcast.delayed_position(self.match.id, 60), 1)
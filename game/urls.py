@@ -4,6 +4,16 @@ from game import views
 
 urlpatterns = patterns('',
     url(r'^(?P<match_id>\d+?)$', views.game_view, name='game_view'),
+    url(r'^(?P<match_id>\d+?)/steps$', views.step_feed_view,
+        name='step_feed_view'),
+    url(r'^(?P<match_id>\d+?)/history$', views.history_view,
+        name='history_view'),
+    url(r'^(?P<match_id>\d+?)/odds$', views.odds_view,
+        name='odds_view'),
+    url(r'^(?P<match_id>\d+?)/watch$', views.spectate_view,
+        name='spectate_view'),
+    url(r'^(?P<match_id>\d+?)/watch/steps$', views.spectator_feed_view,
+        name='spectator_feed_view'),
     url(r'^team/(?P<team_slug>.+?)$', views.team_view, name='team_view'),
     url(r'^create-team$', views.create_team_view, name='create_team_view'),
     url(r'^post_step$', views.post_step_view, name='post_step_view'),
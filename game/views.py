@@ -1,52 +1,154 @@
 import json
+import time
 from time import sleep
 from random import randint
 
 from django.http import HttpResponse, Http404, HttpResponseRedirect
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.gzip import gzip_page
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 
-from game.models import Match, PlayerInGame, Step, Team, Race, Challenge, create_player, create_team, start_match
-from game.steps import resolve
+from game import broadcast, odds, snapshots, state_cache
+from game.catalog import get_catalog
+from game.dice import dice_stream
+from game.serializers import serialize_diff
+from game.step_types import parse_step
+from game.models import Match, Player, Step, Team, Challenge, create_player, create_team, start_match, save_snapshot, compact_json
+from game.session import MatchSession
+from game.steps import block_chooser, other_side, preceding_block
+from game.steps import recorded_dice, resolve
 
 # Create your views here.
 @login_required
 @ensure_csrf_cookie
 def game_view(request, match_id):
-    match = get_object_or_404(Match, id=match_id)
-    home_players = PlayerInGame.objects.filter(
-        match=match, player__team=match.home_team).all()
-    away_players = PlayerInGame.objects.filter(
-        match=match, player__team=match.away_team).all()
-    players_list = []
-    players_list.extend([p.as_dict() for p in home_players])
-    players_list.extend([p.as_dict() for p in away_players])
-    players_json = json.dumps(players_list)
-    history = Step.objects.filter(match=match).order_by('history_position')
-    history = json.dumps([a.as_dict() for a in history])
-    color_home_primary = match.home_team.color_home_primary
-    color_home_secondary = match.home_team.color_home_secondary
-    if match.away_team.color_home_primary == match.home_team.color_home_primary:
-        color_away_primary = match.away_team.color_away_primary
-        color_away_secondary = match.away_team.color_away_secondary
-    else:
-        color_away_primary = match.away_team.color_home_primary
-        color_away_secondary = match.away_team.color_home_secondary
+    return render_match(request, match_id, request.user.username)
+
+@login_required
+def spectate_view(request, match_id):
+    """A read-only view of a match, held back by any spectator delay."""
+    # Nobody is the coach, so the page will not let the spectator play
+    return render_match(request, match_id, '', broadcast.spectator_delay())
+
+def is_coach(user, match):
+    """Whether the user coaches one of the teams in the match."""
+    return user.id in (match.home_team.coach_id, match.away_team.coach_id)
+
+def render_match(request, match_id, username, delay=0):
+    # Both the state and the history come from the cache when they can
+    try:
+        position = broadcast.delayed_position(match_id, delay)
+        state = state_cache.get_state(match_id, position)
+    except (Match.DoesNotExist, ValueError):
+        raise Http404
+    # Only the current turn is sent with the page, and the rest of the
+    # history is fetched afterwards from history_view
+    since = max(state['match']['turnStartPosition'] - 1, 0)
+    payloads = broadcast.payloads(match_id, since, delay)[:position - since]
+    history = '[' + ','.join(payloads) + ']'
     data = {
-        'players_json': players_json,
-        'match_data': json.dumps(match.as_dict()),
+        'players_json': json.dumps(state['players']),
+        'match_data': json.dumps(state['match']),
         'match_history': history,
-        'username': request.user.username,
-        'color_home_primary': color_home_primary,
-        'color_home_secondary': color_home_secondary,
-        'color_away_primary': color_away_primary,
-        'color_away_secondary': color_away_secondary,
+        'username': username,
     }
+    data.update(state['colors'])
     return render(request, 'game/game.html', data)
 
+@login_required
+@gzip_page
+def history_view(request, match_id):
+    """Stream steps as newline-delimited JSON, one step per line.
+
+    The optional `since` and `until` parameters limit the history to
+    positions from `since` up to but not including `until`. Anyone but
+    the coaches only gets as far as the spectator delay allows.
+    """
+    match = get_object_or_404(
+        Match.objects.select_related('home_team', 'away_team'), id=match_id)
+    steps = Step.objects.filter(match_id=match_id)
+    if 'since' in request.GET:
+        steps = steps.filter(
+            history_position__gte=position_param(request, 'since'))
+    if 'until' in request.GET:
+        steps = steps.filter(
+            history_position__lt=position_param(request, 'until'))
+    if not is_coach(request.user, match):
+        steps = steps.filter(history_position__lt=broadcast.delayed_position(
+            match_id, broadcast.spectator_delay()))
+    steps = steps.order_by('history_position').iterator()
+    # Encode each line here, as gzip_page expects streamed bytes
+    lines = ((json.dumps(step.as_dict()) + '\n').encode('utf-8')
+             for step in steps)
+    return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+@login_required
+def odds_view(request, match_id):
+    """Return the chance that a move along `path`, or a block on the
+    player `targetNum`, succeeds for the player `side`/`num`."""
+    try:
+        session = MatchSession(match_id)
+    except Match.DoesNotExist:
+        raise Http404
+    try:
+        player = session.player(request.GET['side'], request.GET['num'])
+        if 'targetNum' in request.GET:
+            defender = session.player(
+                other_side(player.side), request.GET['targetNum'])
+            chance = odds.block_odds(session, player, defender)
+        else:
+            path = [(int(x), int(y))
+                    for x, y in json.loads(request.GET['path'])]
+            chance = odds.path_odds(session, player, path)
+    except (KeyError, ValueError) as error:
+        result = {'status': 'invalid', 'message': str(error)}
+    else:
+        result = {'status': 0, 'odds': float(chance),
+                  'exact': str(chance)}
+    return HttpResponse(json.dumps(result), content_type="application/json")
+
+@login_required
+def step_feed_view(request, match_id):
+    """Return the steps from position `since` onwards to a coach."""
+    match = get_object_or_404(
+        Match.objects.select_related('home_team', 'away_team'), id=match_id)
+    if not is_coach(request.user, match):
+        raise Http404
+    return step_feed(request, match_id, 0)
+
+@login_required
+def spectator_feed_view(request, match_id):
+    """Return steps like step_feed_view, held back by any delay."""
+    return step_feed(request, match_id, broadcast.spectator_delay())
+
+def position_param(request, name, default=None):
+    """Return a history position from the query string, or 404."""
+    try:
+        position = int(request.GET.get(name, default))
+    except (TypeError, ValueError):
+        raise Http404
+    if position < 0:
+        raise Http404
+    return position
+
+def step_feed(request, match_id, delay):
+    # Answer straight away and let the page poll again, so that no request
+    # holds on to a worker while it waits for the other coach
+    since = position_param(request, 'since', 0)
+    try:
+        payloads = broadcast.payloads(match_id, since, delay)
+    except Match.DoesNotExist:
+        raise Http404
+    # The payloads are already JSON, so just join them together
+    data = '{{"steps": [{}], "next": {}}}'.format(
+        ','.join(payloads), since + len(payloads))
+    return HttpResponse(data, content_type="application/json")
+
 @login_required
 def team_view(request, team_slug):
     team = get_object_or_404(Team, slug=team_slug)
@@ -79,7 +181,7 @@ def create_team_view(request):
                     'name': name,
                     'position': position
                 })
-        race = Race.objects.get(singular=team_dict['race'])
+        race = get_catalog().race(team_dict['race'])
         team = create_team(
             team_dict['name'],
             race,
@@ -90,25 +192,27 @@ def create_team_view(request):
             color_away_primary=team_dict['color_away_primary'],
             color_away_secondary=team_dict['color_away_secondary'],
         )
-        team.save()
-        for player in team_dict['players']:
+        players = [
             create_player(
                 team,
                 player['position'],
                 player['name'],
                 player['number']
-            ).save()
-        team.update_value()
-        team.cash = 1000 - team.value
-        team.update_value()
-        if team.valid_starting_team():
-            team.save()
+            ) for player in team_dict['players']]
+        # Check the team before anything is saved, so that there is
+        # nothing to clear up if it is not allowed
+        cost = sum(player.value for player in players)
+        cost += team.rerolls * race.reroll_cost
+        team.cash = 1000 - cost
+        team.value = cost + team.cash
+        if team.valid_starting_team(players):
+            with transaction.atomic():
+                team.save()
+                for player in players:
+                    player.team = team
+                Player.objects.bulk_create(players)
             url = reverse('game:team_view', kwargs={'team_slug': team.slug})
             return HttpResponseRedirect(url)
-        else:
-            for player in team.player_set.all():
-                player.delete()
-            team.delete()
     colors = [
         '31,120,180',
         '51,160,44',
@@ -119,7 +223,7 @@ def create_team_view(request):
     ]
     data = {
         'number_range': range(1, 17),
-        'race_list': Race.objects.all(),
+        'race_list': get_catalog().race_list(),
         'username': request.user.username,
         'colors': colors,
     }
@@ -167,69 +271,123 @@ def reject_challenge_view(request, challenge_id):
 @login_required
 def post_step_view(request):
     # sleep(randint(1, 5))
-    # Get the match in question
     print('post_step_view')
     print('POST:', request.POST)
-    match = Match.objects.get(id=request.POST['matchId'])
-    # Check that it's the correct user
-    step_type = request.POST['stepType']
-    if match.current_side == 'home':
-        expected_user = match.home_team.coach.username
+    if 'steps' in request.POST:
+        # A batch of steps, e.g. those resent after a dropped connection
+        steps = json.loads(request.POST['steps'])
+        if not steps:
+            return step_response({'status': 'invalid',
+                                  'message': 'No steps sent'})
+        if len(set(str(data['matchId']) for data in steps)) > 1:
+            return step_response({'status': 'invalid',
+                                  'message': 'Steps for several matches'})
+    else:
+        steps = [request.POST.dict()]
+    with transaction.atomic():
+        # Get the match in question, locking it so that steps are appended
+        # one request at a time
+        session = MatchSession(steps[0]['matchId'], lock=True)
+        first_position = session.match.next_position
+        results = []
+        for data in steps:
+            if results and results[-1]['status'] not in (0, 'duplicate'):
+                # The rest of the batch follows on from the step that
+                # failed, so leave it for the client to send again
+                results.append({'status': 'skipped'})
+            else:
+                results.append(post_step(request, session, data))
+        # Write back everything the steps changed
+        session.flush()
+    if session.match.next_position > first_position:
+        # Pass the new steps and state on to anyone watching
+        broadcast.publish(list(Step.objects.filter(
+            match=session.match, history_position__gte=first_position,
+            history_position__lt=session.match.next_position)))
+        state_cache.store(session.match, session.players.values())
+    if 'steps' in request.POST:
+        result = {'status': 0, 'results': results}
     else:
-        expected_user = match.away_team.coach.username
+        result = results[0]
+    return step_response(result)
+
+def step_response(result):
+    result_json = json.dumps(result)
+    return HttpResponse(result_json, content_type="application/json")
+
+def post_step(request, session, data):
+    """Check where a posted step fits in the history and resolve it."""
+    match = session.match
+    # Check that it's the correct user
+    step_type = data['stepType']
+    expected_side = match.current_side
+    if step_type == 'resolveBlock':
+        # The stronger player's coach chooses the block dice
+        block = preceding_block(session, match.next_position)
+        if block is not None:
+            expected_side = block_chooser(block)
+    expected_user = match.team(expected_side).coach.username
     if request.user.username != expected_user and step_type != 'setKickoff':
-        result = {'status': 'wrongUser'}
+        return {'status': 'wrongUser'}
+    expected_position = match.next_position
+    # Check where this new step fits in with the history
+    history_position = int(data['historyPosition'])
+    print('expected:', expected_position, 'actual:', history_position)
+    if history_position > expected_position:
+        # Missing some history, so request it be resent
+        result = {'status': 'resend',
+                  'start': expected_position}
+    elif history_position < expected_position:
+        # Already have this one
+        # Should also check against the database for consistency
+        result = {'status': 'duplicate'}
     else:
-        # Check what steps have previously been saved
-        history_saved = Step.objects.filter(match=match).values_list(
-            'history_position', flat=True).order_by('history_position')
-        if len(history_saved) == 0:
-            expected_position = 0
-        else:
-            expected_position = history_saved[len(history_saved)-1] + 1
-        # Check where this new step fits in with the history
-        history_position = int(request.POST['historyPosition'])
-        print('expected:', expected_position, 'actual:', history_position)
-        if history_position > expected_position:
-            # Missing some history, so request it be resent
-            result = {'status': 'resend',
-                      'start': expected_position}
-        elif history_position < expected_position:
-            # Already have this one
-            # Should also check against the database for consistency
-            result = {'status': 'duplicate'}
-        else:
-            # This is the next step, as expected
-            # Turn the POST data into a model step
-            properties = {key: value for key, value in request.POST.items() 
-                          if key not in ['stepType', 'matchId', 'historyPosition']}
-            print(str(history_position) + ':', properties)
-            step = Step(
-                step_type=step_type,
-                match=match,
-                history_position=history_position,
-                properties=json.dumps(properties))
-            try:
+        # This is the next step, as expected
+        # Turn the POST data into a model step
+        properties = {key: value for key, value in data.items() 
+                      if key not in ['stepType', 'matchId', 'historyPosition']}
+        print(str(history_position) + ':', properties)
+        try:
+            properties = parse_step(step_type, properties)
+        except ValueError as e:
+            return {'status': 'invalid', 'message': str(e)}
+        step = Step(
+            step_type=step_type,
+            match=match,
+            history_position=history_position)
+        step.set_data(properties)
+        values = session.values()
+        stream = dice_stream(match.dice_seed, history_position)
+        try:
+            # The step is only kept if the rules accept it
+            with transaction.atomic():
                 step.save()
-            except IntegrityError:
-                # A conflicting step exists in the database
-                result = {'status': 'duplicate'}
-            else:
+                match.next_position = history_position + 1
                 # Carry out the step
                 print(str(history_position) + ':', "Carrying out the step")
-                try:
-                    result = resolve(match, step_type, properties)
-                except Exception as e:
-                    print(e)
-                    raise
-                # Add the result to the step in the database
-                step.result = json.dumps(result)
-                step.save()
-                # Tell the client that everything is ok
-                result['status'] = 0
-    result_json = json.dumps(result)
-    try:
-        print(str(history_position) + ':', result_json)
-    except NameError:
-        pass
-    return HttpResponse(result_json, content_type="application/json")
+                with recorded_dice(stream=stream) as rolls:
+                    result = resolve(session, step_type, properties)
+        except IntegrityError:
+            # A conflicting step exists in the database
+            result = {'status': 'duplicate'}
+        except (KeyError, ValueError) as e:
+            # Not allowed by the rules, so undo whatever it had changed
+            session.revert(values)
+            result = {'status': 'invalid', 'message': str(e)}
+        else:
+            # Add the result to the step in the database
+            step.result = compact_json(result)
+            if stream is None:
+                # The dice cannot be regenerated, so keep them for replays
+                step.rolls = compact_json(rolls)
+            diff = serialize_diff(session.changes(values))
+            step.diff = compact_json(diff)
+            step.published = time.time()
+            step.save(update_fields=['result', 'rolls', 'diff', 'published'])
+            if snapshots.is_due(step_type, match.next_position):
+                save_snapshot(match, session.players.values())
+            # Tell the client that everything is ok, and what changed
+            result['diff'] = diff
+            result['status'] = 0
+    print(str(history_position) + ':', json.dumps(result))
+    return result